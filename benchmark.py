@@ -0,0 +1,304 @@
+"""
+Нагрузочный тест бота без сети.
+
+Поднимает локальные замены Telegram Bot API и ЮMoney, запускает бота
+в режиме polling поверх них и проводит N пользователей через путь
+/start -> subscribe -> выбор тарифа -> оплата -> окончание подписки.
+Результат (обновлений в секунду, p50/p99 времени обработки, вызовы API на
+пользователя) пишется в JSON; с --baseline он сравнивается с прошлым
+прогоном, и при регрессии скрипт завершается с кодом 1:
+
+    python benchmark.py --users 200 --output bench.json
+    python benchmark.py --users 200 --baseline bench.json
+"""
+import argparse
+import asyncio
+import datetime
+import importlib
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List
+from urllib.parse import parse_qs, urlsplit
+import aiohttp
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from callback_router import TariffCallback
+from fake_telegram_api import FakeTelegramServer
+from fake_yoomoney_api import FakeYooMoneyServer, ACCOUNT
+from yoomoney_api import QUICKPAY_URL
+
+# ID первого тестового пользователя (администраторы - вне этого диапазона)
+FIRST_USER_ID = 100000
+# Интервал опроса истории ЮMoney во время теста, секунд
+BENCH_POLL_INTERVAL = 0.2
+# Вызовы, которые делает не бот на пользователя: служебные методы Bot API и оплата формы
+SERVICE_METHODS = ("getUpdates", "getMe", "deleteWebhook", "quickpay")
+# Сколько после опустошения очереди не должно быть новых вызовов Bot API, секунд
+QUIET_PERIOD = 0.5
+# Допустимое ухудшение относительно --baseline (доля)
+DEFAULT_TOLERANCE = 0.2
+
+
+class LatencyRecorder(BaseMiddleware):
+    """Записывает время обработки каждого обновления в текущую фазу теста"""
+
+    def __init__(self):
+        self.phase = ""
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        phase = self.phase
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.latencies[phase].append(time.perf_counter() - start)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль методом ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    """p50/p99/max в миллисекундах"""
+    return {
+        "p50": round(percentile(values, 50) * 1000, 3),
+        "p99": round(percentile(values, 99) * 1000, 3),
+        "max": round(max(values, default=0.0) * 1000, 3)
+    }
+
+
+async def wait_until(condition: Callable[[], Awaitable[bool]], timeout: float, what: str) -> None:
+    """Ждет выполнения условия, проверяя его каждые 20 мс"""
+    deadline = time.monotonic() + timeout
+    while not await condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Не дождались: {what}")
+        await asyncio.sleep(0.02)
+
+
+class Benchmark:
+    """Один прогон: стенды, бот и сценарий для users пользователей"""
+
+    def __init__(self, users: int, tariff: str, timeout: float):
+        self.user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + users))
+        self.tariff = tariff
+        self.timeout = timeout
+        self.telegram = FakeTelegramServer()
+        self.yoomoney = FakeYooMoneyServer()
+        self.recorder = LatencyRecorder()
+        self.phases: Dict[str, Dict] = {}
+        self.app = None
+
+    def _configure(self, workdir: str) -> None:
+        """Переменные окружения бота: стенды вместо реальных API, временные файлы"""
+        os.environ.update({
+            "BOT_TOKEN": "100000:bench",
+            "YOOMONEY_ACCESS_TOKEN": "bench",
+            "YOOMONEY_RECEIVER": ACCOUNT,
+            "ADMIN_IDS": "1",
+            "CHANNEL_ID": "-1001000000000",
+            "TELEGRAM_API_URL": self.telegram.url,
+            "YOOMONEY_API_URL": self.yoomoney.api_url,
+            "DATABASE_PATH": os.path.join(workdir, "bot_database.db"),
+            "MEDIA_CACHE_PATH": os.path.join(workdir, "media_cache.json"),
+            "SERVICE_HTTP_HOST": "127.0.0.1",
+            "SERVICE_HTTP_PORT": "0",
+            "METRICS_HTTP_HOST": "127.0.0.1",
+            "METRICS_HTTP_PORT": "0",
+            "SLOW_UPDATE_SECONDS": "0"
+        })
+        os.environ.pop("YOOMONEY_NOTIFICATION_SECRET", None)
+
+    async def _updates_phase(self, name: str, push: Callable[[int], None]) -> None:
+        """Отдает боту по одному обновлению от каждого пользователя и ждет их обработки"""
+        self.recorder.phase = name
+        latencies = self.recorder.latencies[name]
+        start = time.perf_counter()
+        for user_id in self.user_ids:
+            push(user_id)
+
+        async def handled():
+            return len(latencies) >= len(self.user_ids)
+        await wait_until(handled, self.timeout, f"обработка фазы {name}")
+        seconds = time.perf_counter() - start
+        self.phases[name] = {
+            "updates": len(latencies),
+            "seconds": round(seconds, 3),
+            "updates_per_second": round(len(latencies) / seconds, 1),
+            "latency_ms": latency_summary(latencies)
+        }
+
+    async def _payment_phase(self) -> None:
+        """Пользователи оплачивают ссылки из сообщений бота, бот находит оплаты опросом"""
+        labels = []
+        start = time.perf_counter()
+        async with aiohttp.ClientSession() as session:
+            for user_id in self.user_ids:
+                url = self.telegram.find_url(user_id, QUICKPAY_URL)
+                if url is None:
+                    raise RuntimeError(f"Бот не отправил пользователю {user_id} ссылку на оплату")
+                labels.append(parse_qs(urlsplit(url).query)["label"][0])
+                async with session.post(self.yoomoney.quickpay_url + "?" + urlsplit(url).query) as response:
+                    response.raise_for_status()
+
+        async def settled():
+            return all([await self.app.db.is_label_paid(label) for label in labels])
+        await wait_until(settled, self.timeout, "зачисление оплат")
+        self.phases["payment"] = {"seconds": round(time.perf_counter() - start, 3)}
+
+    async def _expiry_phase(self) -> None:
+        """Подписки заканчиваются, бот удаляет пользователей из канала"""
+        start = time.perf_counter()
+        ended = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        for user_id in self.user_ids:
+            await self.app.db.update_user_subscription(user_id, ended)
+
+        async def removed():
+            return self.telegram.calls["unbanChatMember"] >= len(self.user_ids)
+        await wait_until(removed, self.timeout, "удаление из канала")
+        self.phases["expiry"] = {"seconds": round(time.perf_counter() - start, 3)}
+
+    async def _scenario(self) -> None:
+        app = self.app
+
+        async def elected():
+            return app.leader.is_leader
+        await wait_until(elected, self.timeout, "выбор лидера")
+
+        await self._updates_phase("start", lambda user_id: self.telegram.push_command(user_id, "/start"))
+        await self._updates_phase("subscribe", lambda user_id: self.telegram.push_callback(user_id, "subscribe"))
+        tariff = TariffCallback(code=self.tariff).pack()
+        await self._updates_phase("tariff", lambda user_id: self.telegram.push_callback(user_id, tariff))
+        await self._payment_phase()
+        await self._expiry_phase()
+
+        # Очередь пуста, и последние взятые из нее сообщения успели уйти
+        last_calls = [sum(self.telegram.calls.values()), time.monotonic()]
+
+        async def drained():
+            calls = sum(self.telegram.calls.values())
+            if app.outbox.depth or calls != last_calls[0]:
+                last_calls[:] = [calls, time.monotonic()]
+                return False
+            return time.monotonic() - last_calls[1] >= QUIET_PERIOD
+        await wait_until(drained, self.timeout, "отправка очереди сообщений")
+
+    def report(self) -> Dict:
+        """Итог прогона в виде словаря для JSON"""
+        users = len(self.user_ids)
+        latencies = [value for values in self.recorder.latencies.values() for value in values]
+        handled = sum(phase.get("seconds", 0) for name, phase in self.phases.items() if "updates" in phase)
+        return {
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "users": users,
+            "tariff": self.tariff,
+            "updates": len(latencies),
+            "updates_per_second": round(len(latencies) / handled, 1) if handled else 0.0,
+            "latency_ms": latency_summary(latencies),
+            "phases": self.phases,
+            "api_calls_per_user": {
+                "telegram": {
+                    method: round(count / users, 3)
+                    for method, count in sorted(self.telegram.calls.items()) if method not in SERVICE_METHODS
+                },
+                "yoomoney": {
+                    method: round(count / users, 3)
+                    for method, count in sorted(self.yoomoney.calls.items()) if method not in SERVICE_METHODS
+                }
+            }
+        }
+
+    async def run(self) -> Dict:
+        await self.telegram.start()
+        await self.yoomoney.start()
+        workdir = tempfile.mkdtemp(prefix="bench_")
+        try:
+            self._configure(workdir)
+            # Бот настраивается при импорте, поэтому импортируем после переменных окружения
+            self.app = importlib.import_module("bot")
+            self.app.payment_handler.payment_poller.interval = BENCH_POLL_INTERVAL
+            self.app.dp.update.outer_middleware(self.recorder)
+            polling = asyncio.create_task(self.app.dp.start_polling(
+                self.app.bot, handle_signals=False, allowed_updates=self.app.dp.resolve_used_update_types()
+            ))
+            try:
+                await self._scenario()
+            finally:
+                await self.app.dp.stop_polling()
+                await polling
+            return self.report()
+        finally:
+            await self.telegram.stop()
+            await self.yoomoney.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Регрессии относительно baseline: пропускная способность, p99 и число вызовов API"""
+    regressions = []
+    if result["updates_per_second"] < baseline["updates_per_second"] * (1 - tolerance):
+        regressions.append(f"updates/s: {baseline['updates_per_second']} -> {result['updates_per_second']}")
+    for name, phase in result["phases"].items():
+        before = baseline["phases"].get(name, {}).get("latency_ms")
+        if before and phase["latency_ms"]["p99"] > before["p99"] * (1 + tolerance):
+            regressions.append(f"{name} p99: {before['p99']} -> {phase['latency_ms']['p99']} мс")
+    for api, methods in result["api_calls_per_user"].items():
+        for method, calls in methods.items():
+            was = baseline["api_calls_per_user"].get(api, {}).get(method, 0)
+            # Вызовы Bot API детерминированы и сравниваются без допуска,
+            # число опросов истории ЮMoney зависит от времени зачисления
+            allowed = was * (1 + tolerance) if api == "yoomoney" else was
+            if calls > allowed:
+                regressions.append(f"{api}.{method} на пользователя: {was} -> {calls}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных стендах")
+    parser.add_argument("--users", type=int, default=100, help="количество пользователей")
+    parser.add_argument("--tariff", default="sub_standard", help="тариф (платный, чтобы сработало окончание)")
+    parser.add_argument("--output", default="benchmark_results.json", help="куда записать результат")
+    parser.add_argument("--baseline", help="прошлый результат для сравнения")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="допустимое ухудшение (доля)")
+    parser.add_argument("--timeout", type=float, default=120, help="предельное время одной фазы, секунд")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    result = asyncio.run(Benchmark(args.users, args.tariff, args.timeout).run())
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(f"{result['users']} пользователей, {result['updates']} обновлений, "
+          f"{result['updates_per_second']} обновлений/с, p50 {result['latency_ms']['p50']} мс, "
+          f"p99 {result['latency_ms']['p99']} мс")
+    for name, phase in result["phases"].items():
+        print(f"  {name}: {json.dumps(phase, ensure_ascii=False)}")
+    print(f"Результат записан в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"РЕГРЕССИЯ: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
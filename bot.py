@@ -1,23 +1,40 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
 from aiogram.filters import Command
-from aiogram.types import Message, FSInputFile
+from aiogram.types import Message
 from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
 import os
-from yoomoney import Client
+from yoomoney_api import YooMoneyClient, YOOMONEY_API_URL
 import datetime
 
-from keyboards import get_main_keyboard, get_subscription_keyboard, get_admin_keyboard, get_subscription_management_keyboard
-from payment_handlers import PaymentHandler
+from keyboards import (
+    get_main_keyboard, get_subscription_keyboard, get_admin_keyboard, get_subscription_management_keyboard,
+    get_subscribers_keyboard, SUBSCRIBER_FILTERS
+)
+from payment_handlers import PaymentHandler, SUBSCRIPTION_PRICES
 from handlers import MessageHandler
 from database import Database
-from functions import check_user_channel_subscription, remove_user_from_channel, check_and_remove_expired_users, ChannelManager
-from utils import is_admin
-
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+from functions import ChannelManager
+from expiry_scheduler import ExpiryScheduler
+from stats import StatsRecomputer
+from webhook import run_webhook
+from http_server import HttpServer
+from payment_notifications import PaymentNotificationHandler
+from payment_poller import POLL_INTERVAL
+from leader import LeaderElection
+from loop_monitor import LoopStallMonitor
+from media import MediaRegistry, MEDIA_CACHE_PATH
+from outbox import Outbox, PRIORITY_NOTICE
+from metrics import OUTBOX_DEPTH, PENDING_PAYMENTS, JOB_SECONDS, handle_metrics
+from middlewares import HandlerMetricsMiddleware, TelegramMetricsMiddleware, UpdateProfilingMiddleware, UserSerialMiddleware
+from callback_router import (
+    CallbackRouter, TariffCallback, ExtendCallback, AdminExtendCallback, AdminCancelCallback, AdminSubscribersCallback
+)
+from utils import is_admin, from_timestamp
 
 # Загрузка переменных окружения
 env_path = os.path.join(os.path.dirname(__file__), '.env')
@@ -44,6 +61,41 @@ YOOMONEY_TOKEN = os.getenv('YOOMONEY_ACCESS_TOKEN')
 WALLET_NUMBER = os.getenv('YOOMONEY_RECEIVER')
 ADMIN_IDS = list(map(int, os.getenv('ADMIN_IDS', '').split(',')))  # Список ID администраторов
 CHANNEL_ID = os.getenv('CHANNEL_ID')
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling или webhook
+STATS_RECOMPUTE_HOURS = float(os.getenv('STATS_RECOMPUTE_HOURS', '24'))  # 0 - без пересчета
+
+# Настройки режима webhook
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL')  # https://bot.example.com
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+
+# HTTP-уведомления ЮMoney о входящих переводах (без секрета остается только опрос)
+YOOMONEY_NOTIFICATION_SECRET = os.getenv('YOOMONEY_NOTIFICATION_SECRET')
+YOOMONEY_NOTIFICATION_PATH = os.getenv('YOOMONEY_NOTIFICATION_PATH', '/yoomoney/notification')
+# Интервал резервного опроса истории, когда работают уведомления, секунд
+FALLBACK_POLL_INTERVAL = float(os.getenv('FALLBACK_POLL_INTERVAL', '120'))
+# Служебный HTTP-сервер (уведомления ЮMoney)
+SERVICE_HTTP_HOST = os.getenv('SERVICE_HTTP_HOST', '0.0.0.0')
+SERVICE_HTTP_PORT = int(os.getenv('SERVICE_HTTP_PORT', '8081'))
+# Метрики Prometheus отдаются без авторизации, поэтому по умолчанию только на
+# loopback; для сбора с другой машины адрес задается явно (METRICS_HTTP_HOST=0.0.0.0)
+METRICS_HTTP_HOST = os.getenv('METRICS_HTTP_HOST', '127.0.0.1')
+METRICS_HTTP_PORT = int(os.getenv('METRICS_HTTP_PORT', '8082'))
+# Время жизни кеша пользователей, секунд (при нескольких экземплярах бота - несколько секунд)
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '600'))
+# Профилирование обновлений: порог медленного обновления (0 - выключено), секунд,
+# и доля обновлений под cProfile (файл лога медленных обновлений - SLOW_UPDATE_LOG, см. logging_setup.py)
+SLOW_UPDATE_SECONDS = float(os.getenv('SLOW_UPDATE_SECONDS', '1'))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+# Порог блокировки цикла событий синхронным кодом, мс (0 - сторож выключен)
+LOOP_STALL_MS = float(os.getenv('LOOP_STALL_MS', '100'))
+# Адреса API и пути к файлам (меняются для локального Bot API сервера и стендов benchmark.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # например http://127.0.0.1:8090
+YOOMONEY_API_BASE = os.getenv('YOOMONEY_API_URL', YOOMONEY_API_URL)
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'bot_database.db')
+MEDIA_CACHE_FILE = os.getenv('MEDIA_CACHE_PATH', MEDIA_CACHE_PATH)
 
 # Отладочная информация
 logging.info(f"BOT_TOKEN найден: {'Да' if BOT_TOKEN else 'Нет'}")
@@ -60,24 +112,73 @@ if not WALLET_NUMBER:
     raise ValueError("YOOMONEY_RECEIVER не найден в переменных окружения")
 
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
+api_server = TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else PRODUCTION
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=api_server))
+bot.session.middleware(TelegramMetricsMiddleware())
 dp = Dispatcher()
 
+# Все callback-запросы проходят через один обработчик с поиском по словарю
+callback_router = CallbackRouter()
+callback_router.setup(dp)
+
+# Время обработки команд и кнопок
+handler_metrics = HandlerMetricsMiddleware(callback_router, commands=("start", "balance", "extend"))
+dp.message.outer_middleware(handler_metrics)
+dp.callback_query.outer_middleware(handler_metrics)
+
+# Обновления одного пользователя обрабатываются по очереди, разных - параллельно
+user_serial = UserSerialMiddleware()
+dp.message.outer_middleware(user_serial)
+dp.callback_query.outer_middleware(user_serial)
+
+# Время каждого обновления целиком с разбивкой по БД, Telegram и ЮMoney
+dp.update.outer_middleware(UpdateProfilingMiddleware(SLOW_UPDATE_SECONDS, PROFILE_SAMPLE_RATE))
+
 # Инициализация клиента ЮMoney
-yoomoney_client = Client(YOOMONEY_TOKEN)
+yoomoney_client = YooMoneyClient(YOOMONEY_TOKEN, base_url=YOOMONEY_API_BASE)
 
 # Инициализация базы данных
-db = Database()
+db = Database(DATABASE_PATH, user_cache_ttl=USER_CACHE_TTL)
 
-# Словарь для хранения режимов работы для админов
-admin_test_modes = {}
+# Очередь исходящих сообщений с учетом лимитов Telegram
+outbox = Outbox(bot)
+
+# Реестр file_id картинок, чтобы не загружать их при каждой отправке
+media = MediaRegistry(MEDIA_CACHE_FILE)
 
 # Инициализация обработчиков
-message_handler = MessageHandler(bot, yoomoney_client)
-payment_handler = PaymentHandler(bot, yoomoney_client, WALLET_NUMBER, db)
+message_handler = MessageHandler(bot, yoomoney_client, media)
+payment_handler = PaymentHandler(
+    bot, yoomoney_client, WALLET_NUMBER, db, media, outbox,
+    # При работающих уведомлениях опрос истории нужен только как подстраховка
+    poll_interval=FALLBACK_POLL_INTERVAL if YOOMONEY_NOTIFICATION_SECRET else POLL_INTERVAL
+)
+
+# Метрики слушают отдельный (по умолчанию локальный) адрес
+metrics_server = HttpServer(METRICS_HTTP_HOST, METRICS_HTTP_PORT)
+metrics_server.add_route("GET", "/metrics", handle_metrics)
+# Служебный HTTP-сервер: уведомления ЮMoney
+service_server = HttpServer(SERVICE_HTTP_HOST, SERVICE_HTTP_PORT)
+OUTBOX_DEPTH.set_function(lambda: outbox.depth)
+PENDING_PAYMENTS.set_function(lambda: payment_handler.payment_poller.pending_count)
+if YOOMONEY_NOTIFICATION_SECRET:
+    notification_handler = PaymentNotificationHandler(YOOMONEY_NOTIFICATION_SECRET, payment_handler.handle_notification)
+    service_server.add_route("POST", YOOMONEY_NOTIFICATION_PATH, notification_handler.handle)
 
 # Инициализация менеджеров
-channel_manager = ChannelManager(bot, CHANNEL_ID)
+channel_manager = ChannelManager(bot, CHANNEL_ID, db)
+# Статусы участников канала приходят в обновлениях chat_member
+dp.chat_member.register(channel_manager.on_chat_member)
+
+# Планировщик окончания подписок получает изменения сроков из базы
+expiry_scheduler = ExpiryScheduler(bot, db, channel_manager, outbox)
+db.add_subscription_listener(expiry_scheduler.schedule)
+
+# Сторож цикла событий: находит синхронные вызовы внутри обработчиков
+loop_monitor = LoopStallMonitor(LOOP_STALL_MS)
+
+# Периодическая сверка агрегатов статистики
+stats_recomputer = StatsRecomputer(db, STATS_RECOMPUTE_HOURS)
 
 # Регистрация обработчиков команд
 @dp.message(Command("start"))
@@ -92,14 +193,15 @@ async def cmd_start(message: types.Message):
         if not user:
             # Создаем нового пользователя только если его нет в базе
             username_at = f"@{message.from_user.username}" if message.from_user.username else None
+            now = datetime.datetime.now()
             await db.create_user(
                 user_id=message.from_user.id,
                 first_name=message.from_user.first_name,
                 username=message.from_user.username or "Unknown",
                 username_at=username_at,
                 label="basic_user",
-                subscription_start=datetime.datetime.now(),
-                subscription_end=datetime.datetime.now()
+                subscription_start=now,
+                subscription_end=now
             )
         else:
             # Если пользователь существует, обновляем только его имя и username
@@ -112,9 +214,9 @@ async def cmd_start(message: types.Message):
             )
         
         # Отправляем приветственное сообщение с фото
-        photo = FSInputFile("imgs/1.png")
-        await message.answer_photo(
-            photo=photo,
+        await media.send_photo(
+            message.answer_photo,
+            "imgs/1.png",
             caption=(
                 "📌 *Добро пожаловать.*\n"
                 "_Ты зашёл в систему, которая работает._\n\n"
@@ -130,7 +232,7 @@ async def cmd_start(message: types.Message):
         logging.error(f"Ошибка в обработчике /start: {e}")
         await message.answer("Произошла ошибка при обработке команды. Пожалуйста, попробуйте позже.")
 
-@dp.callback_query(lambda c: c.data == "admin_panel")
+@callback_router.action("admin_panel")
 async def process_admin_panel(callback_query: types.CallbackQuery):
     """Обработчик входа в админ-панель"""
     if not is_admin(callback_query.from_user.id, ADMIN_IDS):
@@ -138,7 +240,7 @@ async def process_admin_panel(callback_query: types.CallbackQuery):
         return
     
     # Получаем текущий режим для админа
-    is_test_mode = admin_test_modes.get(callback_query.from_user.id, False)
+    is_test_mode = await db.get_admin_test_mode(callback_query.from_user.id)
     
     # Удаляем предыдущее сообщение
     try:
@@ -153,16 +255,17 @@ async def process_admin_panel(callback_query: types.CallbackQuery):
         reply_markup=get_admin_keyboard(is_test_mode)
     )
 
-@dp.callback_query(lambda c: c.data == "toggle_test_mode")
+@callback_router.action("toggle_test_mode")
 async def process_admin_test_mode(callback_query: types.CallbackQuery):
     """Обработчик переключения тестового режима"""
     if not is_admin(callback_query.from_user.id, ADMIN_IDS):
         await callback_query.answer("⛔ У вас нет доступа к этой функции.", show_alert=True)
         return
     
-    # Переключаем режим для админа
-    admin_test_modes[callback_query.from_user.id] = not admin_test_modes.get(callback_query.from_user.id, False)
-    current_mode = "тестовый" if admin_test_modes[callback_query.from_user.id] else "реальный"
+    # Переключаем режим для админа (режим хранится в базе и общий для всех экземпляров бота)
+    is_test_mode = not await db.get_admin_test_mode(callback_query.from_user.id)
+    await db.set_admin_test_mode(callback_query.from_user.id, is_test_mode)
+    current_mode = "тестовый" if is_test_mode else "реальный"
     
     # Удаляем предыдущее сообщение
     try:
@@ -175,10 +278,10 @@ async def process_admin_test_mode(callback_query: types.CallbackQuery):
         f"👨‍💼 Панель администратора\n"
         f"Режим работы: {current_mode}\n"
         f"Выберите действие:",
-        reply_markup=get_admin_keyboard(admin_test_modes[callback_query.from_user.id])
+        reply_markup=get_admin_keyboard(is_test_mode)
     )
 
-@dp.callback_query(lambda c: c.data == "main_menu")
+@callback_router.action("main_menu")
 async def process_main_menu(callback_query: types.CallbackQuery):
     """Обработчик возврата в главное меню"""
     is_user_admin = is_admin(callback_query.from_user.id, ADMIN_IDS)
@@ -197,17 +300,52 @@ async def process_main_menu(callback_query: types.CallbackQuery):
     )
 
 # Добавляем заглушки для новых функций админ-панели
-@dp.callback_query(lambda c: c.data == "admin_stats")
+@callback_router.action("admin_stats")
 async def process_admin_stats(callback_query: types.CallbackQuery):
     """Обработчик просмотра статистики"""
     if not is_admin(callback_query.from_user.id, ADMIN_IDS):
         await callback_query.answer("⛔ У вас нет доступа к этой функции.", show_alert=True)
         return
     
-    # TODO: Добавить реальную статистику
-    await callback_query.answer("📊 Функция статистики в разработке", show_alert=True)
+    try:
+        stats = await db.get_stats()
+        
+        tariff_names = {info["label"]: info["name"] for info in SUBSCRIPTION_PRICES.values()}
+        active_total = sum(stats["active"].values())
+        active_lines = "".join(
+            f"  • {tariff_names.get(label, label)}: {count}\n"
+            for label, count in sorted(stats["active"].items())
+        ) or "  • нет\n"
+        churn_base = active_total + stats["lapsed"]
+        churn_rate = stats["lapsed"] / churn_base * 100 if churn_base else 0
+        
+        text = (
+            "📊 Статистика\n\n"
+            f"👥 Активных подписок: {active_total}\n"
+            f"{active_lines}"
+            f"⏳ Истекает в ближайшие 24 ч: {stats['expiring']}\n"
+            f"📉 Отток за 7 дней: {stats['lapsed']} ({churn_rate:.1f}%)\n\n"
+            f"💳 Оплат сегодня: {stats['today']['payments']} на {stats['today']['income']:.2f}₽\n"
+            f"💳 Оплат за 7 дней: {stats['week']['payments']} на {stats['week']['income']:.2f}₽\n"
+            f"💰 Выручка всего: {stats['total']['income']:.2f}₽ ({stats['total']['payments']} оплат)\n\n"
+            f"🆕 Новых пользователей сегодня: {stats['today']['new_users']}, "
+            f"за 7 дней: {stats['week']['new_users']}"
+        )
+        
+        await callback_query.message.edit_text(
+            text,
+            reply_markup=get_admin_keyboard(await db.get_admin_test_mode(callback_query.from_user.id))
+        )
+    except TelegramBadRequest as e:
+        # Статистика не изменилась с прошлого нажатия
+        if "message is not modified" not in str(e):
+            logging.error(f"Ошибка при показе статистики: {e}")
+        await callback_query.answer()
+    except Exception as e:
+        logging.error(f"Ошибка при получении статистики: {e}")
+        await callback_query.answer("❌ Ошибка при получении статистики.", show_alert=True)
 
-@dp.callback_query(lambda c: c.data == "admin_users")
+@callback_router.action("admin_users")
 async def process_admin_users(callback_query: types.CallbackQuery):
     """Обработчик просмотра пользователей"""
     if not is_admin(callback_query.from_user.id, ADMIN_IDS):
@@ -217,7 +355,7 @@ async def process_admin_users(callback_query: types.CallbackQuery):
     # TODO: Добавить список пользователей
     await callback_query.answer("👥 Функция просмотра пользователей в разработке", show_alert=True)
 
-@dp.callback_query(lambda c: c.data == "admin_balance")
+@callback_router.action("admin_balance")
 async def process_admin_balance(callback_query: types.CallbackQuery):
     """Обработчик просмотра баланса"""
     if not is_admin(callback_query.from_user.id, ADMIN_IDS):
@@ -225,7 +363,7 @@ async def process_admin_balance(callback_query: types.CallbackQuery):
         return
     
     try:
-        user = yoomoney_client.account_info()
+        user = await yoomoney_client.account_info()
         
         # Удаляем предыдущее сообщение
         try:
@@ -238,13 +376,13 @@ async def process_admin_balance(callback_query: types.CallbackQuery):
             f"💰 Баланс кошелька: {user.balance} {user.currency}\n\n"
             "👨‍💼 Панель администратора\n"
             "Выберите действие:",
-            reply_markup=get_admin_keyboard(admin_test_modes.get(callback_query.from_user.id, False))
+            reply_markup=get_admin_keyboard(await db.get_admin_test_mode(callback_query.from_user.id))
         )
     except Exception as e:
         logging.error(f"Ошибка при получении баланса: {e}")
         await callback_query.answer("❌ Ошибка при получении баланса", show_alert=True)
 
-@dp.callback_query(lambda c: c.data == "admin_settings")
+@callback_router.action("admin_settings")
 async def process_admin_settings(callback_query: types.CallbackQuery):
     """Обработчик настроек"""
     if not is_admin(callback_query.from_user.id, ADMIN_IDS):
@@ -254,32 +392,32 @@ async def process_admin_settings(callback_query: types.CallbackQuery):
     # TODO: Добавить настройки
     await callback_query.answer("⚙️ Функция настроек в разработке", show_alert=True)
 
-@dp.callback_query(lambda c: c.data == "subscribe")
+@callback_router.action("subscribe")
 async def process_subscribe_button(callback_query: types.CallbackQuery):
     await message_handler.process_subscribe_button(callback_query)
 
-@dp.callback_query(lambda c: c.data.startswith("sub_"))
-async def process_subscription_choice(callback_query: types.CallbackQuery):
+@callback_router.payload(TariffCallback)
+async def process_subscription_choice(callback_query: types.CallbackQuery, callback_data: TariffCallback):
     # Проверяем, является ли пользователь админом и включен ли для него тестовый режим
-    is_test_mode = is_admin(callback_query.from_user.id, ADMIN_IDS) and admin_test_modes.get(callback_query.from_user.id, False)
+    is_test_mode = is_admin(callback_query.from_user.id, ADMIN_IDS) and await db.get_admin_test_mode(callback_query.from_user.id)
     
     # Удаляем сообщение с выбором тарифа
     await callback_query.message.delete()
     
     # Обрабатываем выбор подписки
-    await payment_handler.process_subscription_choice(callback_query, test_mode=is_test_mode)
+    await payment_handler.process_subscription_choice(callback_query, callback_data.code, test_mode=is_test_mode)
 
-@dp.callback_query(lambda c: c.data.startswith("extend_"))
-async def process_extend_subscription(callback_query: types.CallbackQuery):
+@callback_router.payload(ExtendCallback)
+async def process_extend_subscription(callback_query: types.CallbackQuery, callback_data: ExtendCallback):
     """Обработчик продления подписки"""
-    await payment_handler.process_extend_subscription(callback_query)
+    await payment_handler.process_extend_subscription(callback_query, callback_data.code)
 
-@dp.callback_query(lambda c: c.data == "cancel_extend")
+@callback_router.action("cancel_extend")
 async def process_cancel_extend(callback_query: types.CallbackQuery):
     """Обработчик отмены продления подписки"""
     await payment_handler.process_cancel_extend(callback_query)
 
-@dp.callback_query(lambda c: c.data == "cancel_payment")
+@callback_router.action("cancel_payment")
 async def cancel_payment(callback_query: types.CallbackQuery):
     await message_handler.cancel_payment(callback_query)
 
@@ -287,75 +425,89 @@ async def cancel_payment(callback_query: types.CallbackQuery):
 async def cmd_balance(message: Message):
     await message_handler.cmd_balance(message)
 
-@dp.callback_query(lambda c: c.data == "admin_subscriptions")
+# Количество пользователей на одной странице списка подписчиков
+SUBSCRIBERS_PAGE_SIZE = 10
+
+def format_subscriber(user: dict) -> str:
+    """Строка списка подписчиков; статус и остаток времени посчитаны в SQL"""
+    remaining = ""
+    if user["status"] == "active":
+        status = "✅ Активна"
+        days, rest = divmod(user["seconds_left"], 86400)
+        remaining = f"(осталось: {days}д {rest // 3600}ч)"
+    elif user["status"] == "expired":
+        status = "⚠️ Истекла"
+    else:
+        status = "❌ Неактивна"
+    first_name = (user['first_name'] or 'Без имени')[:32]
+    return (
+        f"👤 {first_name} {user['username_at'] or ''} (ID: {user['user_id']})\n"
+        f"📝 Статус: {user['label']}\n"
+        f"🔄 Подписка: {status} {remaining}\n"
+        f"⚡️ Действия: /extend_{user['user_id']}\n"
+        "➖➖➖➖➖➖➖➖➖➖\n"
+    )
+
+async def show_subscribers_page(callback_query: types.CallbackQuery, status: str, cursor: int, backwards: bool):
+    """Показывает страницу списка подписчиков"""
+    status_filter = None if status == "all" else status
+    users, has_more = await db.get_subscribers_page(status_filter, cursor, backwards, SUBSCRIBERS_PAGE_SIZE)
+    total = await db.count_subscribers(status_filter)
+    
+    if backwards:
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor > 0, has_more
+    
+    text = f"📋 Пользователи: {SUBSCRIBER_FILTERS[status]} (всего: {total})\n\n"
+    if users:
+        text += "".join(format_subscriber(user) for user in users)
+        text += "\n🔍 Для управления подпиской пользователя, нажмите на соответствующую команду /extend_ID"
+    else:
+        text += "📝 Список пользователей пуст"
+    
+    await callback_query.message.edit_text(
+        text,
+        reply_markup=get_subscribers_keyboard(
+            status,
+            users[0]["user_id"] if users else None,
+            users[-1]["user_id"] if users else None,
+            has_prev and bool(users),
+            has_next and bool(users)
+        )
+    )
+
+@callback_router.action("admin_subscriptions")
 async def process_admin_subscriptions(callback_query: types.CallbackQuery):
     """Обработчик просмотра списка подписчиков"""
+    await process_admin_subscribers_page(
+        callback_query, AdminSubscribersCallback(status="all", cursor=0, backwards=False)
+    )
+
+@callback_router.payload(AdminSubscribersCallback)
+async def process_admin_subscribers_page(callback_query: types.CallbackQuery, callback_data: AdminSubscribersCallback):
+    """Обработчик фильтров и листания списка подписчиков"""
     if not is_admin(callback_query.from_user.id, ADMIN_IDS):
         await callback_query.answer("⛔ У вас нет доступа к этой функции.", show_alert=True)
         return
+    if callback_data.status not in SUBSCRIBER_FILTERS:
+        await callback_query.answer("❌ Неизвестный фильтр.", show_alert=True)
+        return
     
     try:
-        # Получаем список всех пользователей
-        users = await db.get_all_users()
-        
-        if not users:
-            await callback_query.message.edit_text(
-                "📝 Список пользователей пуст\n\n"
-                "👨‍💼 Панель администратора\n"
-                "Выберите действие:",
-                reply_markup=get_admin_keyboard(admin_test_modes.get(callback_query.from_user.id, False))
-            )
-            return
-        
-        # Формируем текст со списком пользователей
-        current_time = datetime.datetime.now()
-        text = "📋 Список пользователей и их подписок:\n\n"
-        
-        for user in users:
-            # Получаем информацию о подписке
-            subscription_end = datetime.datetime.strptime(
-                user["subscription_end"],
-                "%d.%m.%Y %H:%M:%S"
-            ) if user["subscription_end"] else None
-            
-            # Определяем статус подписки
-            status = "❌ Неактивна"
-            remaining = ""
-            if subscription_end:
-                if subscription_end > current_time:
-                    status = "✅ Активна"
-                    time_left = subscription_end - current_time
-                    days = time_left.days
-                    hours = time_left.seconds // 3600
-                    remaining = f"(осталось: {days}д {hours}ч)"
-                else:
-                    status = "⚠️ Истекла"
-            
-            # Добавляем информацию о пользователе
-            text += (
-                f"👤 {user['first_name'] or 'Без имени'} {user['username_at'] or ''} (ID: {user['user_id']})\n"
-                f"📝 Статус: {user['label']}\n"
-                f"🔄 Подписка: {status} {remaining}\n"
-                f"⚡️ Действия: /extend_{user['user_id']}\n"
-                "➖➖➖➖➖➖➖➖➖➖\n"
-            )
-        
-        # Добавляем инструкцию по использованию
-        text += "\n🔍 Для управления подпиской пользователя, нажмите на соответствующую команду /extend_ID"
-        
-        # Отправляем сообщение с информацией
-        await callback_query.message.edit_text(
-            text,
-            reply_markup=get_admin_keyboard(admin_test_modes.get(callback_query.from_user.id, False))
-        )
-        
+        await show_subscribers_page(callback_query, callback_data.status, callback_data.cursor, callback_data.backwards)
+    except TelegramBadRequest as e:
+        # Нажатие на текущий фильтр не меняет сообщение
+        if "message is not modified" not in str(e):
+            raise
+        await callback_query.answer()
     except Exception as e:
         logging.error(f"Ошибка при получении списка пользователей: {e}")
         await callback_query.message.edit_text(
             "❌ Произошла ошибка при получении списка пользователей\n\n"
             "👨‍💼 Панель администратора\n"
             "Выберите действие:",
-            reply_markup=get_admin_keyboard(admin_test_modes.get(callback_query.from_user.id, False))
+            reply_markup=get_admin_keyboard(await db.get_admin_test_mode(callback_query.from_user.id))
         )
 
 @dp.message(lambda message: message.text and message.text.startswith("/extend_"))
@@ -376,10 +528,7 @@ async def process_extend_command(message: types.Message):
             return
         
         # Отправляем сообщение с клавиатурой для управления подпиской
-        subscription_end = datetime.datetime.strptime(
-            user["subscription_end"],
-            "%d.%m.%Y %H:%M:%S"
-        ) if user["subscription_end"] else "не активна"
+        subscription_end = from_timestamp(user["subscription_end"]) or "не активна"
         
         await message.answer(
             f"👤 Управление подпиской пользователя:\n"
@@ -397,23 +546,16 @@ async def process_extend_command(message: types.Message):
         logging.error(f"Ошибка при обработке команды продления: {e}")
         await message.answer("❌ Произошла ошибка при обработке команды.")
 
-@dp.callback_query(lambda c: c.data.startswith("admin_extend_"))
-async def process_admin_extend(callback_query: types.CallbackQuery):
+@callback_router.payload(AdminExtendCallback)
+async def process_admin_extend(callback_query: types.CallbackQuery, callback_data: AdminExtendCallback):
     """Обработчик продления подписки администратором"""
     if not is_admin(callback_query.from_user.id, ADMIN_IDS):
         await callback_query.answer("⛔ У вас нет доступа к этой функции.", show_alert=True)
         return
     
     try:
-        # Разбираем callback_data
-        _, _, user_id, period = callback_query.data.split("_")
-        user_id = int(user_id)
-        
-        # Получаем информацию о пользователе
-        user = await db.get_user(user_id)
-        if not user:
-            await callback_query.answer("❌ Пользователь не найден.", show_alert=True)
-            return
+        user_id = callback_data.user_id
+        period = callback_data.period
         
         # Определяем длительность продления
         duration_map = {
@@ -426,23 +568,15 @@ async def process_admin_extend(callback_query: types.CallbackQuery):
             await callback_query.answer("❌ Неверный период продления.", show_alert=True)
             return
         
-        # Определяем новую дату окончания подписки
-        current_end = datetime.datetime.strptime(
-            user["subscription_end"],
-            "%d.%m.%Y %H:%M:%S"
-        ) if user["subscription_end"] else datetime.datetime.now()
-        
-        # Если подписка истекла, начинаем с текущего момента
-        if current_end < datetime.datetime.now():
-            current_end = datetime.datetime.now()
-        
-        new_end = current_end + duration
-        
-        # Обновляем дату окончания подписки
-        await db.update_user_subscription(
-            user_id=user_id,
-            subscription_end=new_end
-        )
+        # Продлеваем от текущего окончания (или от текущего момента, если подписка истекла);
+        # дата считается в базе, поэтому одновременная оплата пользователя не теряется
+        async with db.user_lock(user_id):
+            end_ts = await db.extend_subscription(user_id, duration)
+            user = await db.get_user(user_id)
+        if end_ts is None or not user:
+            await callback_query.answer("❌ Пользователь не найден.", show_alert=True)
+            return
+        new_end = from_timestamp(end_ts)
         
         # Получаем ссылку на канал
         try:
@@ -465,10 +599,7 @@ async def process_admin_extend(callback_query: types.CallbackQuery):
             if invite_link:
                 message_text += f"\n\n🔗 Ссылка на канал: {invite_link}"
             
-            await bot.send_message(
-                chat_id=user_id,
-                text=message_text
-            )
+            outbox.send_message(user_id, message_text, PRIORITY_NOTICE)
         except Exception as e:
             logging.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
         
@@ -484,16 +615,15 @@ async def process_admin_extend(callback_query: types.CallbackQuery):
         logging.error(f"Ошибка при продлении подписки: {e}")
         await callback_query.answer("❌ Произошла ошибка при продлении подписки.", show_alert=True)
 
-@dp.callback_query(lambda c: c.data.startswith("admin_cancel_"))
-async def process_admin_cancel(callback_query: types.CallbackQuery):
+@callback_router.payload(AdminCancelCallback)
+async def process_admin_cancel(callback_query: types.CallbackQuery, callback_data: AdminCancelCallback):
     """Обработчик отмены подписки администратором"""
     if not is_admin(callback_query.from_user.id, ADMIN_IDS):
         await callback_query.answer("⛔ У вас нет доступа к этой функции.", show_alert=True)
         return
     
     try:
-        # Получаем ID пользователя из callback_data
-        user_id = int(callback_query.data.replace("admin_cancel_", ""))
+        user_id = callback_data.user_id
         
         # Получаем информацию о пользователе
         user = await db.get_user(user_id)
@@ -524,7 +654,7 @@ async def process_admin_cancel(callback_query: types.CallbackQuery):
         logging.error(f"Ошибка при отмене подписки: {e}")
         await callback_query.answer("❌ Произошла ошибка при отмене подписки.", show_alert=True)
 
-@dp.callback_query(lambda c: c.data == "admin_channel")
+@callback_router.action("admin_channel")
 async def admin_channel_handler(callback_query: types.CallbackQuery):
     """Обработчик управления каналом"""
     if not is_admin(callback_query.from_user.id, ADMIN_IDS):
@@ -538,7 +668,7 @@ async def admin_channel_handler(callback_query: types.CallbackQuery):
             "1. Добавьте бота в канал как администратора\n"
             "2. Установите переменную CHANNEL_ID в файле .env\n"
             "Пример: CHANNEL_ID=-100123456789",
-            reply_markup=get_admin_keyboard(admin_test_modes.get(callback_query.from_user.id, False))
+            reply_markup=get_admin_keyboard(await db.get_admin_test_mode(callback_query.from_user.id))
         )
         return
 
@@ -546,56 +676,117 @@ async def admin_channel_handler(callback_query: types.CallbackQuery):
         chat = await bot.get_chat(CHANNEL_ID)
         members_count = await bot.get_chat_member_count(CHANNEL_ID)
         
-        expired_users = await db.get_expired_subscriptions()
-        expired_count = 0
-        
-        for user in expired_users:
-            if await check_user_channel_subscription(bot, CHANNEL_ID, user['user_id']):
-                expired_count += 1
+        expired_count = await channel_manager.count_unpaid_members()
         
         message = (
             f"📢 Информация о канале\n\n"
             f"Название: {chat.title}\n"
             f"ID: {CHANNEL_ID}\n"
             f"Участников: {members_count}\n"
-            f"Пользователей с истекшей подпиской: {expired_count}\n\n"
+            f"В канале без действующей подписки: {expired_count}\n\n"
             f"🤖 Статус бота: ✅ Администратор\n"
             f"Автоудаление: ✅ Активно"
         )
         
         await callback_query.message.edit_text(
             message,
-            reply_markup=get_admin_keyboard(admin_test_modes.get(callback_query.from_user.id, False))
+            reply_markup=get_admin_keyboard(await db.get_admin_test_mode(callback_query.from_user.id))
         )
     except Exception as e:
         logging.error(f"Ошибка при получении информации о канале: {e}")
         await callback_query.message.edit_text(
             "❌ Ошибка при получении информации о канале. "
             "Проверьте права бота и ID канала.",
-            reply_markup=get_admin_keyboard(admin_test_modes.get(callback_query.from_user.id, False))
+            reply_markup=get_admin_keyboard(await db.get_admin_test_mode(callback_query.from_user.id))
         )
 
-# Добавляем запуск проверки при старте бота
-async def on_startup(dp):
-    asyncio.create_task(check_and_remove_expired_users(bot, CHANNEL_ID, db))
+# Фоновые задачи выполняет только один экземпляр бота (лидер)
+async def start_leader_tasks():
+    # Запускаем опрос оплат (с восстановлением ожидающих)
+    await payment_handler.start_background_tasks()
+    
+    # Сверка участников канала
+    await channel_manager.load()
+    
+    # Запуск планировщика окончания подписок
+    await expiry_scheduler.start()
+    
+    # Периодическая сверка статистики
+    stats_recomputer.start()
+
+async def stop_leader_tasks():
+    await payment_handler.stop_background_tasks()
+    await expiry_scheduler.stop()
+    await stats_recomputer.stop()
+    await channel_manager.stop()
+
+async def sync_leader_state():
+    # Подхватываем сроки подписок и оплаты, записанные другими экземплярами
+    with JOB_SECONDS.time(job="leader_sync"):
+        await expiry_scheduler.sync()
+        await payment_handler.resume_payment_intents(grace=None)
+
+leader = LeaderElection(db, start_leader_tasks, stop_leader_tasks, sync_leader_state)
+
+# Запуск и остановка (вызываются aiogram и при polling, и при webhook)
+async def on_startup():
+    # Следим за блокировками цикла событий с самого начала
+    loop_monitor.start()
+    
+    # Открываем общее соединение с базой данных
+    await db.connect()
+    await db.warm_user_cache()
+    
+    # Запускаем очередь исходящих сообщений
+    outbox.start()
+    
+    # Метрики и служебный HTTP-сервер (уведомления ЮMoney)
+    await metrics_server.start()
+    await service_server.start()
+    
+    # Фоновые задачи запустятся, если этот экземпляр станет лидером
+    leader.start()
+
+async def on_shutdown():
+    # Останавливаем фоновые задачи при завершении работы
+    # (сессию бота после этого закрывает aiogram)
+    await service_server.stop()
+    await metrics_server.stop()
+    await leader.stop()
+    await outbox.stop()
+    await payment_handler.close()
+    await yoomoney_client.close()
+    await db.close()
+    await loop_monitor.stop()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
 
 # Функция запуска бота
-async def main():
+async def main(mode: str = BOT_MODE):
+    """
+    Запускает бота
+    
+    Args:
+        mode (str): 'polling' (по умолчанию) или 'webhook'
+    """
+    # chat_member не приходит, пока его не запросить явно
+    allowed_updates = dp.resolve_used_update_types()
     try:
-        # Запускаем фоновые задачи
-        await payment_handler.start_background_tasks()
-        
-        # Запуск задачи проверки подписок при старте
-        await on_startup(dp)
-        
-        # Запуск бота
-        await dp.start_polling(bot)
+        if mode == "webhook":
+            if not WEBHOOK_BASE_URL or not WEBHOOK_SECRET:
+                raise ValueError("Для режима webhook нужны WEBHOOK_BASE_URL и WEBHOOK_SECRET")
+            await run_webhook(
+                bot, dp, WEBHOOK_BASE_URL, WEBHOOK_SECRET,
+                path=WEBHOOK_PATH, host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                allowed_updates=allowed_updates
+            )
+        else:
+            # Переход с webhook обратно на polling
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=allowed_updates)
     except Exception as e:
         logging.error(f"Ошибка при запуске бота: {e}")
-    finally:
-        # Останавливаем фоновые задачи при завершении работы
-        await payment_handler.stop_background_tasks()
-        await bot.session.close()
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,122 @@
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Type
+from aiogram import Dispatcher, types
+from aiogram.filters.callback_data import CallbackData
+
+CallbackHandler = Callable[..., Awaitable[None]]
+
+# Разделитель полей в callback_data (значение по умолчанию в aiogram)
+CALLBACK_SEPARATOR = ":"
+
+
+# Типизированные callback_data для кнопок с параметрами
+class TariffCallback(CallbackData, prefix="tariff"):
+    """Выбор тарифа подписки"""
+    code: str
+
+
+class ExtendCallback(CallbackData, prefix="extend"):
+    """Продление подписки по тарифу"""
+    code: str
+
+
+class AdminExtendCallback(CallbackData, prefix="admin_extend"):
+    """Продление подписки пользователя администратором"""
+    user_id: int
+    period: str
+
+
+class AdminCancelCallback(CallbackData, prefix="admin_cancel"):
+    """Отмена подписки пользователя администратором"""
+    user_id: int
+
+
+class AdminSubscribersCallback(CallbackData, prefix="admin_subs"):
+    """Страница списка подписчиков: фильтр, user_id-курсор и направление листания"""
+    status: str
+    cursor: int
+    backwards: bool
+
+
+class CallbackRouter:
+    """
+    Маршрутизатор callback-запросов по словарю.
+
+    Кнопки без параметров ищутся по точному совпадению callback_data,
+    кнопки с параметрами - по префиксу CallbackData, после чего данные
+    разбираются один раз и передаются обработчику готовым объектом.
+    Стоимость маршрутизации не зависит от числа зарегистрированных кнопок.
+    """
+
+    def __init__(self):
+        self._actions: Dict[str, CallbackHandler] = {}
+        self._payloads: Dict[str, Tuple[Type[CallbackData], CallbackHandler]] = {}
+
+    def action(self, data: str):
+        """Декоратор: обработчик кнопки с фиксированным callback_data"""
+        def decorator(handler: CallbackHandler) -> CallbackHandler:
+            if data in self._actions:
+                raise ValueError(f"Обработчик для '{data}' уже зарегистрирован")
+            self._actions[data] = handler
+            return handler
+        return decorator
+
+    def payload(self, callback_data: Type[CallbackData]):
+        """Декоратор: обработчик кнопки с типизированным callback_data"""
+        def decorator(handler: CallbackHandler) -> CallbackHandler:
+            prefix = callback_data.__prefix__
+            if prefix in self._payloads:
+                raise ValueError(f"Обработчик для префикса '{prefix}' уже зарегистрирован")
+            self._payloads[prefix] = (callback_data, handler)
+            return handler
+        return decorator
+
+    def route_name(self, data: Optional[str]) -> str:
+        """
+        Имя маршрута для callback_data: фиксированное значение кнопки или префикс
+        CallbackData. Не содержит параметров, поэтому годится как метка метрик.
+        """
+        data = data or ""
+        if data in self._actions:
+            return data
+        prefix, separator, _ = data.partition(CALLBACK_SEPARATOR)
+        if separator and prefix in self._payloads:
+            return prefix
+        return "unknown"
+
+    async def dispatch(self, callback_query: types.CallbackQuery) -> bool:
+        """
+        Вызывает обработчик для callback-запроса
+
+        Returns:
+            bool: True, если обработчик найден
+        """
+        data = callback_query.data or ""
+
+        handler = self._actions.get(data)
+        if handler is not None:
+            await handler(callback_query)
+            return True
+
+        prefix, separator, _ = data.partition(CALLBACK_SEPARATOR)
+        entry = self._payloads.get(prefix) if separator else None
+        if entry is None:
+            return False
+
+        callback_data, handler = entry
+        try:
+            payload = callback_data.unpack(data)
+        except (ValueError, TypeError) as e:
+            logging.error(f"Некорректные callback_data '{data}': {e}")
+            return False
+        await handler(callback_query, payload)
+        return True
+
+    async def _handle(self, callback_query: types.CallbackQuery) -> None:
+        """Единственный обработчик callback-запросов, зарегистрированный в aiogram"""
+        if not await self.dispatch(callback_query):
+            await callback_query.answer("Кнопка устарела. Отправьте /start, чтобы открыть меню заново.")
+
+    def setup(self, dp: Dispatcher) -> None:
+        """Подключает маршрутизатор к диспетчеру aiogram"""
+        dp.callback_query.register(self._handle)
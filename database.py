@@ -1,114 +1,393 @@
 import sqlite3
+import asyncio
 import logging
 import datetime
 import aiosqlite
 import os
-from typing import Optional, List, Dict
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Optional, List, Dict, Tuple
+from utils import to_timestamp, now_timestamp, utc_date
+from user_cache import UserCache, USER_CACHE_TTL
+from keyed_lock import KeyedLock
+from metrics import DB_SECONDS, instrument_methods
+
+# Размер страничного кеша SQLite в КБ (отрицательное значение в PRAGMA cache_size)
+CACHE_SIZE_KB = 16384
+# Сколько ждать снятия блокировки файла другим процессом, мс
+BUSY_TIMEOUT_MS = 5000
+
+# Формат, в котором даты хранились до перехода на epoch
+LEGACY_DATE_FORMAT = "%d.%m.%Y %H:%M:%S"
+
+# Label пользователей с платной подпиской (см. SUBSCRIPTION_PRICES)
+PAID_LABELS = ("standard_user", "premium_user")
+
+# Статус подписки, вычисляемый в SQL: действующая, истекшая или ни разу не оплаченная
+# (у новых пользователей subscription_end совпадает с subscription_start)
+SUBSCRIPTION_STATUS_SQL = """
+    CASE
+        WHEN subscription_end > :now THEN 'active'
+        WHEN subscription_end > subscription_start THEN 'expired'
+        ELSE 'basic'
+    END
+"""
+SUBSCRIPTION_STATUSES = ('active', 'expired', 'basic')
+
+# Ширина корзины в subscription_buckets: подписки группируются по времени окончания
+# с этой точностью, секунд
+STATS_BUCKET_SECONDS = 300
+
+DAILY_STATS_COLUMNS = {
+    'date': 'TEXT PRIMARY KEY',
+    'new_users': 'INTEGER DEFAULT 0',
+    'active_subscriptions': 'INTEGER DEFAULT 0',
+    'total_income': 'REAL DEFAULT 0',
+    'payments': 'INTEGER DEFAULT 0'
+}
+
+# Статусы участника чата, при которых пользователь не состоит в канале
+NOT_MEMBER_STATUSES = ("left", "kicked")
+
+USERS_COLUMNS = {
+    'user_id': 'INTEGER PRIMARY KEY',
+    'first_name': 'TEXT',
+    'username': 'TEXT',
+    'username_at': 'TEXT',
+    'label': 'TEXT',
+    'subscription_start': 'INTEGER',
+    'subscription_end': 'INTEGER',
+    'updated_at': 'INTEGER'
+}
+USERS_COLUMNS_SQL = ", ".join(f"{name} {column_type}" for name, column_type in USERS_COLUMNS.items())
+DATE_COLUMNS = ('subscription_start', 'subscription_end', 'updated_at')
 
 class Database:
-    def __init__(self, db_path: str = "bot_database.db"):
+    def __init__(self, db_path: str = "bot_database.db", user_cache_ttl: float = USER_CACHE_TTL):
         """
         Инициализация подключения к базе данных SQLite
         
         Args:
             db_path (str): Путь к файлу базы данных
+            user_cache_ttl (float): Время жизни записей кеша пользователей, секунд
+                (при нескольких экземплярах бота его стоит уменьшить)
         """
         self.db_path = db_path
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self._subscription_listeners: List[Callable[[int, Optional[str], Optional[int]], None]] = []
+        self.user_cache = UserCache(ttl=user_cache_ttl)
+        # Изменения подписки одного пользователя (оплата, продление, отмена, окончание)
+        # выполняются по очереди: async with db.user_lock(user_id)
+        self.user_lock = KeyedLock()
         self._create_tables()
 
+    def add_subscription_listener(self, listener: Callable[[int, Optional[str], Optional[int]], None]) -> None:
+        """
+        Регистрирует обработчик изменений подписки
+        
+        Args:
+            listener: Функция (user_id, label, subscription_end), где label равен None,
+                если он не менялся, а subscription_end задан в UTC epoch
+        """
+        self._subscription_listeners.append(listener)
+
+    def notify_subscription_change(self, user_id: int, label: Optional[str], subscription_end: Optional[int]) -> None:
+        """Сообщает обработчикам об изменении подписки пользователя"""
+        for listener in self._subscription_listeners:
+            try:
+                listener(user_id, label, subscription_end)
+            except Exception as e:
+                logging.error(f"Ошибка в обработчике изменения подписки пользователя {user_id}: {e}")
+
+    async def connect(self) -> None:
+        """Открывает общее соединение с базой (вызывается при запуске бота)"""
+        async with self._connect_lock:
+            if self._conn is not None:
+                return
+            conn = await aiosqlite.connect(self.db_path)
+            conn.row_factory = aiosqlite.Row
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            await conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+            await conn.execute("PRAGMA temp_store=MEMORY")
+            await conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            self._conn = conn
+            logging.info(f"Открыто соединение с базой данных {self.db_path} (WAL)")
+
+    async def close(self) -> None:
+        """Закрывает общее соединение"""
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    @asynccontextmanager
+    async def connection(self):
+        """Отдает общее соединение для чтения"""
+        if self._conn is None:
+            await self.connect()
+        yield self._conn
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Отдает общее соединение для записи.
+
+        Записи выполняются по очереди; по выходу из блока изменения
+        фиксируются, при исключении откатываются.
+        """
+        if self._conn is None:
+            await self.connect()
+        async with self._write_lock:
+            try:
+                yield self._conn
+                await self._conn.commit()
+            except BaseException:
+                await self._conn.rollback()
+                raise
+
     def _create_tables(self):
         """Создает необходимые таблицы в базе данных"""
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             
             # Создаем таблицу, если она не существует
-            cursor.execute("""
+            cursor.execute(f"""
                 CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    first_name TEXT,
-                    username TEXT,
-                    username_at TEXT,
-                    label TEXT,
-                    subscription_start TEXT,
-                    subscription_end TEXT,
-                    updated_at TEXT
+                    {USERS_COLUMNS_SQL}
                 )
             """)
             
             # Проверяем существующие колонки
             cursor.execute("PRAGMA table_info(users)")
-            existing_columns = {column[1] for column in cursor.fetchall()}
-            required_columns = {
-                'user_id', 'first_name', 'username', 'username_at', 'label', 
-                'subscription_start', 'subscription_end', 'updated_at'
-            }
+            existing_columns = {column[1]: column[2] for column in cursor.fetchall()}
             
             # Добавляем недостающие колонки
-            for column in required_columns - existing_columns:
-                if column == 'user_id':
-                    continue  # Пропускаем PRIMARY KEY
-                cursor.execute(f"ALTER TABLE users ADD COLUMN {column} TEXT")
+            for column, column_type in USERS_COLUMNS.items():
+                if column == 'user_id' or column in existing_columns:
+                    continue  # Пропускаем PRIMARY KEY и существующие колонки
+                cursor.execute(f"ALTER TABLE users ADD COLUMN {column} {column_type}")
+            
+            # Переводим текстовые даты в epoch (один раз для старых баз)
+            if existing_columns.get('subscription_end', 'INTEGER').upper() == 'TEXT':
+                self._migrate_text_dates(cursor)
+            
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_users_label_end
+                ON users (label, subscription_end)
+            """)
+            # Выборка изменений с прошлой сверки (см. get_changed_subscriptions)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_updated ON users (updated_at)")
+            
+            # Агрегаты статистики: по дням (платежи, выручка, новые пользователи) и
+            # число подписок по label и времени окончания
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS daily_stats (
+                    {", ".join(f"{name} {column_type}" for name, column_type in DAILY_STATS_COLUMNS.items())}
+                )
+            """)
+            cursor.execute("PRAGMA table_info(daily_stats)")
+            existing_stats_columns = {column[1] for column in cursor.fetchall()}
+            for column, column_type in DAILY_STATS_COLUMNS.items():
+                if column not in existing_stats_columns:
+                    cursor.execute(f"ALTER TABLE daily_stats ADD COLUMN {column} {column_type}")
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'subscription_buckets'")
+            buckets_exist = cursor.fetchone() is not None
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS subscription_buckets (
+                    label TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    users INTEGER NOT NULL,
+                    PRIMARY KEY (label, bucket)
+                )
+            """)
+            if not buckets_exist:
+                # Первое заполнение по уже существующим подпискам
+                cursor.execute("""
+                    INSERT INTO subscription_buckets (label, bucket, users)
+                    SELECT label, subscription_end / ?, COUNT(*)
+                    FROM users
+                    WHERE label IS NOT NULL AND subscription_end > subscription_start
+                    GROUP BY label, subscription_end / ?
+                """, (STATS_BUCKET_SECONDS, STATS_BUCKET_SECONDS))
+            
+            # Журнал зачисленных оплат. Старая таблица payments (без operation_id)
+            # не использовалась и сохраняется под именем payments_legacy
+            cursor.execute("PRAGMA table_info(payments)")
+            payments_columns = {column[1] for column in cursor.fetchall()}
+            if payments_columns and 'operation_id' not in payments_columns:
+                cursor.execute("ALTER TABLE payments RENAME TO payments_legacy")
+                logging.info("Старая таблица payments переименована в payments_legacy")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS payments (
+                    operation_id TEXT PRIMARY KEY,
+                    label TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    amount REAL,
+                    subscription_type TEXT,
+                    is_extension INTEGER NOT NULL DEFAULT 0,
+                    paid_at INTEGER,
+                    created_at INTEGER NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_user ON payments (user_id, created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_created ON payments (created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_label ON payments (label)")
+            
+            # Ожидающие оплаты, которые восстанавливаются после перезапуска
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS payment_intents (
+                    label TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    subscription_type TEXT NOT NULL,
+                    is_extension INTEGER NOT NULL DEFAULT 0,
+                    created_at INTEGER NOT NULL,
+                    expires_at INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    updated_at INTEGER
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_payment_intents_status ON payment_intents (status, created_at)")
+            
+            # Настройки администраторов (тестовый режим) и аренды фоновых задач,
+            # общие для всех экземпляров бота
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS admin_settings (
+                    admin_id INTEGER PRIMARY KEY,
+                    test_mode INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            
+            # Статусы участников канала, которые бот получает из обновлений chat_member
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS channel_members (
+                    user_id INTEGER PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    updated_at INTEGER
+                )
+            """)
             
             conn.commit()
             logging.info("Структура базы данных успешно обновлена")
 
-    def _format_datetime(self, dt: datetime.datetime) -> str:
+    def _migrate_text_dates(self, cursor: sqlite3.Cursor) -> None:
+        """Пересоздает таблицу users с датами в виде UTC epoch вместо строк Д.М.Г Ч:М:С"""
+        columns = list(USERS_COLUMNS)
+        cursor.execute(f"CREATE TABLE users_migrated ({USERS_COLUMNS_SQL})")
+        cursor.execute(f"SELECT {', '.join(columns)} FROM users")
+        rows = []
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            for column in DATE_COLUMNS:
+                row[column] = self._parse_legacy_datetime(row[column])
+            rows.append(tuple(row[column] for column in columns))
+        cursor.executemany(
+            f"INSERT INTO users_migrated ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            rows
+        )
+        cursor.execute("DROP TABLE users")
+        cursor.execute("ALTER TABLE users_migrated RENAME TO users")
+        logging.info(f"Даты {len(rows)} пользователей переведены в формат epoch")
+
+    @staticmethod
+    def _parse_legacy_datetime(value) -> Optional[int]:
         """
-        Форматирует datetime в строку формата Д.М.Г Ч:M:C
+        Переводит дату старого формата Д.М.Г Ч:М:С в UTC epoch
         
         Args:
-            dt (datetime): Объект datetime для форматирования
+            value: Значение из старой колонки (строка, число или None)
             
         Returns:
-            str: Отформатированная дата и время
+            int: Секунды с начала эпохи или None, если дату не удалось разобрать
         """
-        return dt.strftime("%d.%m.%Y %H:%M:%S")
+        if value is None or isinstance(value, int):
+            return value
+        try:
+            return to_timestamp(datetime.datetime.strptime(value, LEGACY_DATE_FORMAT))
+        except (TypeError, ValueError):
+            logging.error(f"Не удалось разобрать дату при миграции: {value!r}")
+            return None
 
     async def create_user(self, user_id: int, first_name: str, username: str, username_at: str, label: str, 
                          subscription_start: datetime.datetime, 
-                         subscription_end: datetime.datetime) -> None:
-        """Создает нового пользователя или обновляет существующего"""
-        async with aiosqlite.connect(self.db_path) as db:
+                         subscription_end: datetime.datetime, payment: Optional[Dict] = None) -> bool:
+        """
+        Создает нового пользователя или обновляет существующего
+        
+        Args:
+            payment (dict, optional): Оплата, по которой сделана запись (см. record_payment)
+            
+        Returns:
+            bool: False, если оплата уже была зачислена раньше и запись не выполнялась
+        """
+        row = {
+            "user_id": user_id,
+            "first_name": first_name,
+            "username": username,
+            "username_at": username_at,
+            "label": label,
+            "subscription_start": to_timestamp(subscription_start),
+            "subscription_end": to_timestamp(subscription_end),
+            "updated_at": now_timestamp()
+        }
+        async with self.transaction() as db:
+            if payment is not None and not await self.record_payment(db, payment):
+                return False
+            old = await self.read_subscription(db, user_id)
             await db.execute("""
                 INSERT OR REPLACE INTO users 
                 (user_id, first_name, username, username_at, label, subscription_start, subscription_end, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                user_id,
-                first_name,
-                username,
-                username_at,
-                label,
-                subscription_start.strftime("%d.%m.%Y %H:%M:%S"),
-                subscription_end.strftime("%d.%m.%Y %H:%M:%S"),
-                datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-            ))
-            await db.commit()
+                VALUES (:user_id, :first_name, :username, :username_at, :label,
+                        :subscription_start, :subscription_end, :updated_at)
+            """, row)
+            await self.record_subscription_change(db, old, row, payment["amount"] if payment else None)
+        self.user_cache.set(user_id, row)
+        self.notify_subscription_change(user_id, label, row["subscription_end"])
+        return True
 
-    async def get_user(self, user_id: int) -> Optional[Dict]:
-        """Получает информацию о пользователе"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = sqlite3.Row
+    async def get_user(self, user_id: int, fresh: bool = False) -> Optional[Dict]:
+        """
+        Получает информацию о пользователе (сначала из кеша)
+        
+        Args:
+            fresh (bool): Читать из базы в обход кеша (запись могла сделать другая копия бота)
+        """
+        user = None if fresh else self.user_cache.get(user_id)
+        if user is not None:
+            return user
+        
+        async with self.connection() as db:
             async with db.execute(
                 "SELECT * FROM users WHERE user_id = ?",
                 (user_id,)
             ) as cursor:
                 row = await cursor.fetchone()
                 if row:
-                    return dict(row)
+                    user = dict(row)
+                    self.user_cache.set(user_id, user)
+                    return user
                 return None
 
     async def get_all_users(self) -> List[Dict]:
         """Получает список всех пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = sqlite3.Row
+        async with self.connection() as db:
             async with db.execute("SELECT * FROM users") as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
     async def update_user_label(self, user_id: int, label: str, username_at: str = None) -> None:
         """Обновляет label пользователя и username_at если указан"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.transaction() as db:
+            old = await self.read_subscription(db, user_id)
             if username_at is not None:
                 await db.execute("""
                     UPDATE users 
@@ -117,7 +396,7 @@ class Database:
                 """, (
                     label,
                     username_at,
-                    datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
+                    now_timestamp(),
                     user_id
                 ))
             else:
@@ -127,10 +406,17 @@ class Database:
                     WHERE user_id = ?
                 """, (
                     label,
-                    datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
+                    now_timestamp(),
                     user_id
                 ))
-            await db.commit()
+            if old:
+                await self.record_subscription_change(db, old, {**old, "label": label})
+        if old:
+            if username_at is not None:
+                self.user_cache.update(user_id, label=label, username_at=username_at)
+            else:
+                self.user_cache.update(user_id, label=label)
+            self.notify_subscription_change(user_id, label, old["subscription_end"])
 
     async def get_user_subscription_info(self, user_id: int) -> Optional[Dict]:
         """Получает информацию о подписке пользователя"""
@@ -146,21 +432,66 @@ class Database:
 
     async def update_user_subscription(self, user_id: int, subscription_end: datetime.datetime) -> None:
         """Обновляет дату окончания подписки пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        end_ts = to_timestamp(subscription_end)
+        async with self.transaction() as db:
+            old = await self.read_subscription(db, user_id)
             await db.execute("""
                 UPDATE users 
                 SET subscription_end = ?, updated_at = ?
                 WHERE user_id = ?
             """, (
-                subscription_end.strftime("%d.%m.%Y %H:%M:%S"),
-                datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
+                end_ts,
+                now_timestamp(),
                 user_id
             ))
-            await db.commit()
+            if old:
+                await self.record_subscription_change(db, old, {**old, "subscription_end": end_ts})
+        self.user_cache.update(user_id, subscription_end=end_ts)
+        self.notify_subscription_change(user_id, None, end_ts)
+
+    async def extend_subscription(self, user_id: int, duration: datetime.timedelta,
+                                  payment: Optional[Dict] = None) -> Optional[int]:
+        """
+        Продлевает подписку на duration от текущего окончания (или от текущего
+        момента, если подписка истекла).
+
+        Новая дата вычисляется в самом UPDATE, поэтому одновременные продления
+        складываются, а не перезаписывают друг друга.
+
+        Args:
+            payment (dict, optional): Оплата продления (см. record_payment)
+
+        Returns:
+            int: Новое окончание подписки в UTC epoch или None, если пользователя
+                нет или оплата уже была зачислена
+        """
+        now = now_timestamp()
+        async with self.transaction() as db:
+            if payment is not None and not await self.record_payment(db, payment):
+                return None
+            old = await self.read_subscription(db, user_id)
+            if not old:
+                return None
+            await db.execute("""
+                UPDATE users
+                SET subscription_end = MAX(COALESCE(subscription_end, 0), :now) + :seconds,
+                    updated_at = :now
+                WHERE user_id = :user_id
+            """, {"now": now, "seconds": int(duration.total_seconds()), "user_id": user_id})
+            new = await self.read_subscription(db, user_id)
+            await self.record_subscription_change(db, old, new, payment["amount"] if payment else None)
+        self.user_cache.update(user_id, subscription_end=new["subscription_end"], updated_at=now)
+        self.notify_subscription_change(user_id, None, new["subscription_end"])
+        return new["subscription_end"]
 
     async def update_user_info(self, user_id: int, first_name: str, username: str, username_at: str) -> None:
         """Обновляет базовую информацию о пользователе, не трогая данные подписки"""
-        async with aiosqlite.connect(self.db_path) as db:
+        cached = self.user_cache.get(user_id)
+        if cached and (cached["first_name"], cached["username"], cached["username_at"]) == (first_name, username, username_at):
+            # Данные не изменились - запись в базу не нужна
+            return
+        
+        async with self.transaction() as db:
             await db.execute("""
                 UPDATE users 
                 SET first_name = ?,
@@ -172,22 +503,479 @@ class Database:
                 first_name,
                 username,
                 username_at,
-                datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
+                now_timestamp(),
                 user_id
             ))
-            await db.commit()
-            logging.info(f"Обновлена информация пользователя {user_id} (first_name: {first_name}, username: {username})")
+        self.user_cache.update(user_id, first_name=first_name, username=username, username_at=username_at)
+        logging.info(f"Обновлена информация пользователя {user_id} (first_name: {first_name}, username: {username})")
 
     async def get_expired_subscriptions(self) -> List[Dict]:
         """Получает список пользователей с истекшей подпиской"""
-        current_time = datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+        current_time = now_timestamp()
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = sqlite3.Row
-            async with db.execute("""
+        async with self.connection() as db:
+            async with db.execute(f"""
                 SELECT * FROM users 
-                WHERE subscription_end < ? 
-                AND label != 'basic_user'
-            """, (current_time,)) as cursor:
+                WHERE label IN ({', '.join('?' * len(PAID_LABELS))})
+                AND subscription_end < ?
+            """, (*PAID_LABELS, current_time)) as cursor:
                 rows = await cursor.fetchall()
-                return [dict(row) for row in rows] 
\ No newline at end of file
+                return [dict(row) for row in rows]
+
+    async def classify_subscriptions(self, expiring_within: int = 3600) -> List[Dict]:
+        """
+        Получает все платные подписки с их статусом одним запросом
+        
+        Args:
+            expiring_within (int): Сколько секунд до окончания считать подписку истекающей
+            
+        Returns:
+            List[Dict]: user_id, label, subscription_end и status
+                ('expired', 'expiring' или 'active')
+        """
+        now = now_timestamp()
+        async with self.connection() as db:
+            async with db.execute(f"""
+                SELECT user_id, label, subscription_end,
+                    CASE
+                        WHEN subscription_end IS NULL OR subscription_end <= ? THEN 'expired'
+                        WHEN subscription_end <= ? THEN 'expiring'
+                        ELSE 'active'
+                    END AS status
+                FROM users
+                WHERE label IN ({', '.join('?' * len(PAID_LABELS))})
+            """, (now, now + expiring_within, *PAID_LABELS)) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def get_changed_subscriptions(self, since: int) -> List[Dict]:
+        """
+        Получает подписки, записанные начиная с момента since (любыми экземплярами бота)
+        
+        Args:
+            since (int): UTC epoch; строки с updated_at >= since
+            
+        Returns:
+            List[Dict]: user_id, label и subscription_end
+        """
+        async with self.connection() as db:
+            async with db.execute(
+                "SELECT user_id, label, subscription_end FROM users WHERE updated_at >= ?",
+                (since,)
+            ) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def expire_subscription(self, user_id: int) -> bool:
+        """
+        Переводит пользователя с истекшей платной подпиской в basic_user
+        
+        Returns:
+            bool: True, если подписка действительно истекла и была снята
+        """
+        now = now_timestamp()
+        async with self.transaction() as db:
+            old = await self.read_subscription(db, user_id)
+            cursor = await db.execute(f"""
+                UPDATE users
+                SET label = 'basic_user', updated_at = ?
+                WHERE user_id = ?
+                AND label IN ({', '.join('?' * len(PAID_LABELS))})
+                AND subscription_end <= ?
+            """, (now, user_id, *PAID_LABELS, now))
+            expired = cursor.rowcount > 0
+            if expired:
+                await self.record_subscription_change(db, old, {**old, "label": 'basic_user'})
+        if expired:
+            self.user_cache.update(user_id, label='basic_user', updated_at=now)
+        return expired
+
+    async def warm_user_cache(self) -> int:
+        """Заполняет кеш пользователей действующими подписчиками"""
+        async with self.connection() as db:
+            async with db.execute(f"""
+                SELECT * FROM users
+                WHERE label IN ({', '.join('?' * len(PAID_LABELS))})
+                AND subscription_end > ?
+                ORDER BY subscription_end DESC
+                LIMIT ?
+            """, (*PAID_LABELS, now_timestamp(), self.user_cache.maxsize)) as cursor:
+                rows = await cursor.fetchall()
+        count = self.user_cache.warm(dict(row) for row in rows)
+        logging.info(f"В кеш загружено активных подписчиков: {count}")
+        return count
+
+    async def get_channel_members(self) -> Dict[int, str]:
+        """Получает сохраненные статусы участников канала"""
+        async with self.connection() as db:
+            async with db.execute("SELECT user_id, status FROM channel_members") as cursor:
+                rows = await cursor.fetchall()
+                return {row["user_id"]: row["status"] for row in rows}
+
+    async def set_channel_member_status(self, user_id: int, status: str) -> None:
+        """Сохраняет статус пользователя в канале"""
+        async with self.transaction() as db:
+            await db.execute("""
+                INSERT INTO channel_members (user_id, status, updated_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at
+            """, (user_id, status, now_timestamp()))
+
+    async def count_unpaid_channel_members(self) -> int:
+        """Считает пользователей бота, которые состоят в канале без действующей подписки"""
+        async with self.connection() as db:
+            async with db.execute(f"""
+                SELECT COUNT(*) FROM channel_members m
+                JOIN users u ON u.user_id = m.user_id
+                WHERE m.status NOT IN ({', '.join('?' * len(NOT_MEMBER_STATUSES))})
+                AND (u.label NOT IN ({', '.join('?' * len(PAID_LABELS))})
+                     OR u.label IS NULL
+                     OR u.subscription_end IS NULL
+                     OR u.subscription_end <= ?)
+            """, (*NOT_MEMBER_STATUSES, *PAID_LABELS, now_timestamp())) as cursor:
+                row = await cursor.fetchone()
+                return row[0]
+
+    async def get_users_without_channel_status(self) -> List[int]:
+        """Получает ID пользователей, статус которых в канале еще неизвестен"""
+        async with self.connection() as db:
+            async with db.execute("""
+                SELECT user_id FROM users
+                WHERE user_id NOT IN (SELECT user_id FROM channel_members)
+            """) as cursor:
+                rows = await cursor.fetchall()
+                return [row[0] for row in rows]
+
+    async def get_subscribers_page(self, status: Optional[str] = None, cursor: int = 0,
+                                   backwards: bool = False, limit: int = 10) -> Tuple[List[Dict], bool]:
+        """
+        Получает страницу пользователей с keyset-пагинацией по user_id
+        
+        Args:
+            status (str, optional): Фильтр по статусу из SUBSCRIPTION_STATUSES или None для всех
+            cursor (int): user_id, от которого отсчитывается страница (0 - с начала)
+            backwards (bool): Страница перед cursor вместо страницы после него
+            limit (int): Размер страницы
+            
+        Returns:
+            Tuple[List[Dict], bool]: Пользователи по возрастанию user_id с полями status
+                и seconds_left, и есть ли еще записи в направлении листания
+        """
+        params = {"now": now_timestamp(), "cursor": cursor, "status": status, "limit": limit + 1}
+        async with self.connection() as db:
+            async with db.execute(f"""
+                SELECT user_id, first_name, username_at, label, subscription_end,
+                    {SUBSCRIPTION_STATUS_SQL} AS status,
+                    MAX(COALESCE(subscription_end, 0) - :now, 0) AS seconds_left
+                FROM users
+                WHERE user_id {'<' if backwards else '>'} :cursor
+                AND (:status IS NULL OR {SUBSCRIPTION_STATUS_SQL} = :status)
+                ORDER BY user_id {'DESC' if backwards else 'ASC'}
+                LIMIT :limit
+            """, params) as cursor_:
+                rows = [dict(row) for row in await cursor_.fetchall()]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        return rows, has_more
+
+    async def count_subscribers(self, status: Optional[str] = None) -> int:
+        """Считает пользователей с указанным статусом подписки (None - всех)"""
+        async with self.connection() as db:
+            async with db.execute(f"""
+                SELECT COUNT(*) FROM users
+                WHERE :status IS NULL OR {SUBSCRIPTION_STATUS_SQL} = :status
+            """, {"now": now_timestamp(), "status": status}) as cursor:
+                row = await cursor.fetchone()
+                return row[0]
+
+    @staticmethod
+    async def read_subscription(db: aiosqlite.Connection, user_id: int) -> Optional[Dict]:
+        """Читает label и сроки подписки внутри транзакции (перед записью)"""
+        async with db.execute(
+            "SELECT label, subscription_start, subscription_end FROM users WHERE user_id = ?",
+            (user_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            return dict(row) if row else None
+
+    async def record_subscription_change(self, db: aiosqlite.Connection, old: Optional[Dict], new: Optional[Dict],
+                                         amount: Optional[float] = None) -> None:
+        """
+        Обновляет агрегаты статистики в той же транзакции, что и запись подписки
+        
+        Args:
+            db: Соединение, полученное из transaction()
+            old (dict, optional): label, subscription_start и subscription_end до записи (None - пользователя не было)
+            new (dict, optional): Те же поля после записи
+            amount (float, optional): Сумма оплаты, если запись сделана по платежу
+        """
+        if self._bucket_key(old) != self._bucket_key(new):
+            await self._shift_bucket(db, old, -1)
+            await self._shift_bucket(db, new, 1)
+
+        new_users = 1 if old is None and new is not None else 0
+        if new_users or amount is not None:
+            await db.execute("""
+                INSERT INTO daily_stats (date, new_users, payments, total_income)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(date) DO UPDATE SET
+                    new_users = COALESCE(new_users, 0) + excluded.new_users,
+                    payments = COALESCE(payments, 0) + excluded.payments,
+                    total_income = COALESCE(total_income, 0) + excluded.total_income
+            """, (
+                utc_date(now_timestamp()).isoformat(),
+                new_users,
+                1 if amount is not None else 0,
+                amount or 0
+            ))
+
+    @staticmethod
+    def _bucket_key(subscription: Optional[Dict]) -> Optional[tuple]:
+        """Корзина подписки (label, время окончания / STATS_BUCKET_SECONDS) или None, если подписки не было"""
+        if not subscription:
+            return None
+        start, end = subscription.get("subscription_start"), subscription.get("subscription_end")
+        # У пользователей, ни разу не плативших, окончание совпадает с началом
+        if subscription.get("label") is None or start is None or end is None or end <= start:
+            return None
+        return subscription["label"], end // STATS_BUCKET_SECONDS
+
+    async def _shift_bucket(self, db: aiosqlite.Connection, subscription: Optional[Dict], delta: int) -> None:
+        """Прибавляет delta к корзине подписки"""
+        key = self._bucket_key(subscription)
+        if key is None:
+            return
+        await db.execute("""
+            INSERT INTO subscription_buckets (label, bucket, users) VALUES (?, ?, ?)
+            ON CONFLICT(label, bucket) DO UPDATE SET users = users + excluded.users
+        """, (*key, delta))
+
+    async def get_stats(self, expiring_within: int = 86400, churn_period: int = 7 * 86400) -> Dict:
+        """
+        Собирает статистику из агрегатов, не сканируя users.
+        Подписки, истекающие в текущей корзине (до STATS_BUCKET_SECONDS), уже
+        считаются истекшими.
+        
+        Returns:
+            Dict: active (число действующих подписок по label), expiring, lapsed
+                (истекли за churn_period без продления), и today / week / total
+                с new_users, payments и income
+        """
+        now_bucket = now_timestamp() // STATS_BUCKET_SECONDS
+        # Дни статистики считаются по UTC, как и все сроки в базе
+        today = utc_date(now_timestamp())
+        week_start = (today - datetime.timedelta(days=6)).isoformat()
+        params = {
+            "now": now_bucket,
+            "expiring": (now_timestamp() + expiring_within) // STATS_BUCKET_SECONDS,
+            "churn": (now_timestamp() - churn_period) // STATS_BUCKET_SECONDS,
+            "today": today.isoformat(),
+            "week": week_start
+        }
+        async with self.connection() as db:
+            async with db.execute("""
+                SELECT label, SUM(users) FROM subscription_buckets
+                WHERE bucket > :now
+                GROUP BY label
+            """, params) as cursor:
+                active = {row[0]: row[1] for row in await cursor.fetchall() if row[1]}
+            async with db.execute("""
+                SELECT
+                    COALESCE(SUM(CASE WHEN bucket > :now THEN users END), 0),
+                    COALESCE(SUM(CASE WHEN bucket <= :now THEN users END), 0)
+                FROM subscription_buckets
+                WHERE bucket >= :churn AND bucket <= :expiring
+            """, params) as cursor:
+                expiring, lapsed = await cursor.fetchone()
+            async with db.execute("""
+                SELECT
+                    COALESCE(SUM(CASE WHEN date = :today THEN new_users END), 0),
+                    COALESCE(SUM(CASE WHEN date = :today THEN payments END), 0),
+                    COALESCE(SUM(CASE WHEN date = :today THEN total_income END), 0),
+                    COALESCE(SUM(CASE WHEN date >= :week THEN new_users END), 0),
+                    COALESCE(SUM(CASE WHEN date >= :week THEN payments END), 0),
+                    COALESCE(SUM(CASE WHEN date >= :week THEN total_income END), 0),
+                    COALESCE(SUM(payments), 0),
+                    COALESCE(SUM(total_income), 0)
+                FROM daily_stats
+            """, params) as cursor:
+                row = await cursor.fetchone()
+        return {
+            "active": active,
+            "expiring": expiring,
+            "lapsed": lapsed,
+            "today": {"new_users": row[0], "payments": row[1], "income": row[2]},
+            "week": {"new_users": row[3], "payments": row[4], "income": row[5]},
+            "total": {"payments": row[6], "income": row[7]}
+        }
+
+    async def recompute_subscription_buckets(self) -> int:
+        """
+        Пересчитывает subscription_buckets полным проходом по users
+        
+        Returns:
+            int: Количество корзин, которые расходились с пересчитанными
+        """
+        async with self.transaction() as db:
+            async with db.execute("SELECT label, bucket, users FROM subscription_buckets WHERE users != 0") as cursor:
+                current = {(row[0], row[1]): row[2] for row in await cursor.fetchall()}
+            async with db.execute("""
+                SELECT label, subscription_end / ? AS bucket, COUNT(*)
+                FROM users
+                WHERE label IS NOT NULL AND subscription_end > subscription_start
+                GROUP BY label, bucket
+            """, (STATS_BUCKET_SECONDS,)) as cursor:
+                actual = {(row[0], row[1]): row[2] for row in await cursor.fetchall()}
+            await db.execute("DELETE FROM subscription_buckets")
+            await db.executemany(
+                "INSERT INTO subscription_buckets (label, bucket, users) VALUES (?, ?, ?)",
+                [(*key, users) for key, users in actual.items()]
+            )
+        return sum(1 for key in current.keys() | actual.keys() if current.get(key) != actual.get(key))
+
+    async def record_payment(self, db: aiosqlite.Connection, payment: Dict) -> bool:
+        """
+        Записывает оплату в журнал, если операция еще не зачислялась.
+        Вызывается в той же транзакции, что и выдача подписки.
+        
+        Args:
+            db: Соединение, полученное из transaction()
+            payment (dict): operation_id, label, user_id, amount, subscription_type,
+                is_extension и paid_at (UTC epoch)
+            
+        Returns:
+            bool: True, если оплата записана впервые
+        """
+        await db.execute(
+            "UPDATE payment_intents SET status = 'paid', updated_at = ? WHERE label = ?",
+            (now_timestamp(), payment["label"])
+        )
+        cursor = await db.execute("""
+            INSERT OR IGNORE INTO payments
+            (operation_id, label, user_id, amount, subscription_type, is_extension, paid_at, created_at)
+            VALUES (:operation_id, :label, :user_id, :amount, :subscription_type, :is_extension, :paid_at, :created_at)
+        """, {
+            **payment,
+            "is_extension": int(bool(payment.get("is_extension"))),
+            "created_at": now_timestamp()
+        })
+        if cursor.rowcount == 0:
+            logging.warning(f"Операция {payment['operation_id']} (label {payment['label']}) уже зачислена")
+            return False
+        return True
+
+    async def is_label_paid(self, label: str) -> bool:
+        """Проверяет по журналу, зачислена ли оплата с этим label"""
+        async with self.connection() as db:
+            async with db.execute("SELECT 1 FROM payments WHERE label = ? LIMIT 1", (label,)) as cursor:
+                return await cursor.fetchone() is not None
+
+    async def get_user_payments(self, user_id: int, limit: int = 20) -> List[Dict]:
+        """Получает последние оплаты пользователя"""
+        async with self.connection() as db:
+            async with db.execute("""
+                SELECT * FROM payments
+                WHERE user_id = ?
+                ORDER BY created_at DESC
+                LIMIT ?
+            """, (user_id, limit)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def save_payment_intent(self, intent: Dict) -> None:
+        """
+        Сохраняет ожидающую оплату
+        
+        Args:
+            intent (dict): label, user_id, chat_id, subscription_type, is_extension,
+                created_at и expires_at (UTC epoch)
+        """
+        async with self.transaction() as db:
+            await db.execute("""
+                INSERT OR REPLACE INTO payment_intents
+                (label, user_id, chat_id, subscription_type, is_extension, created_at, expires_at, status, updated_at)
+                VALUES (:label, :user_id, :chat_id, :subscription_type, :is_extension, :created_at, :expires_at,
+                        'pending', :created_at)
+            """, {**intent, "is_extension": int(bool(intent.get("is_extension")))})
+
+    async def set_payment_intent_status(self, label: str, status: str) -> None:
+        """Меняет статус ожидающей оплаты ('pending', 'paid', 'expired')"""
+        async with self.transaction() as db:
+            await db.execute(
+                "UPDATE payment_intents SET status = ?, updated_at = ? WHERE label = ? AND status = 'pending'",
+                (status, now_timestamp(), label)
+            )
+
+    async def get_pending_payment_intents(self, created_after: int, limit: int) -> List[Dict]:
+        """Получает последние ожидающие оплаты, созданные после created_after"""
+        async with self.connection() as db:
+            async with db.execute("""
+                SELECT * FROM payment_intents
+                WHERE status = 'pending' AND created_at > ?
+                ORDER BY created_at DESC
+                LIMIT ?
+            """, (created_after, limit)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def expire_payment_intents(self, created_before: int) -> int:
+        """Закрывает ожидающие оплаты, созданные раньше created_before, и возвращает их количество"""
+        async with self.transaction() as db:
+            cursor = await db.execute("""
+                UPDATE payment_intents SET status = 'expired', updated_at = ?
+                WHERE status = 'pending' AND created_at <= ?
+            """, (now_timestamp(), created_before))
+            return cursor.rowcount
+
+    async def get_channel_member_status(self, user_id: int) -> Optional[str]:
+        """Получает сохраненный статус пользователя в канале"""
+        async with self.connection() as db:
+            async with db.execute("SELECT status FROM channel_members WHERE user_id = ?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else None
+
+    async def get_payment_intent(self, label: str) -> Optional[Dict]:
+        """Получает сохраненную оплату по label"""
+        async with self.connection() as db:
+            async with db.execute("SELECT * FROM payment_intents WHERE label = ?", (label,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def get_admin_test_mode(self, admin_id: int) -> bool:
+        """Включен ли тестовый режим у администратора"""
+        async with self.connection() as db:
+            async with db.execute("SELECT test_mode FROM admin_settings WHERE admin_id = ?", (admin_id,)) as cursor:
+                row = await cursor.fetchone()
+                return bool(row and row[0])
+
+    async def set_admin_test_mode(self, admin_id: int, enabled: bool) -> None:
+        """Включает или выключает тестовый режим администратора"""
+        async with self.transaction() as db:
+            await db.execute("""
+                INSERT INTO admin_settings (admin_id, test_mode) VALUES (?, ?)
+                ON CONFLICT(admin_id) DO UPDATE SET test_mode = excluded.test_mode
+            """, (admin_id, int(enabled)))
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """
+        Захватывает или продлевает аренду name на ttl секунд
+        
+        Returns:
+            bool: True, если аренда принадлежит holder (свободна, истекла или уже его)
+        """
+        now = time.time()
+        async with self.transaction() as db:
+            cursor = await db.execute("""
+                INSERT INTO leases (name, holder, expires_at) VALUES (:name, :holder, :expires_at)
+                ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                WHERE leases.holder = excluded.holder OR leases.expires_at < :now
+            """, {"name": name, "holder": holder, "expires_at": now + ttl, "now": now})
+            return cursor.rowcount > 0
+
+    async def release_lease(self, name: str, holder: str) -> None:
+        """Освобождает аренду, если она принадлежит holder"""
+        async with self.transaction() as db:
+            await db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+
+# Время выполнения каждого публичного метода попадает в метрики
+instrument_methods(Database, DB_SECONDS, span="db")
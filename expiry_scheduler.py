@@ -0,0 +1,208 @@
+import asyncio
+import heapq
+import logging
+from typing import Dict, List, Optional, Tuple
+from aiogram import Bot
+from database import Database, PAID_LABELS
+from functions import ChannelManager
+from keyboards import get_subscription_keyboard
+from metrics import JOB_SECONDS
+from outbox import Outbox, PRIORITY_BULK
+from utils import now_timestamp
+
+# За сколько секунд до окончания подписки отправляется напоминание
+REMINDER_BEFORE = 3600
+# Максимальный сон планировщика: страховка от перевода системных часов
+MAX_SLEEP = 3600
+
+KIND_REMIND = "remind"
+KIND_EXPIRE = "expire"
+
+
+class ExpiryScheduler:
+    """
+    Планировщик окончания подписок.
+
+    Держит ближайшие сроки в min-heap и спит до самого раннего из них, поэтому
+    напоминания и отключение выполняются ровно в срок и только для тех
+    пользователей, чей срок наступил. Сроки загружаются из базы при запуске и
+    обновляются через Database.add_subscription_listener при каждой записи;
+    записи других экземпляров бота подхватывает sync по users.updated_at.
+    """
+
+    def __init__(self, bot: Bot, db: Database, channel_manager: ChannelManager, outbox: Outbox):
+        self.bot = bot
+        self.db = db
+        self.channel_manager = channel_manager
+        self.outbox = outbox
+        # (время срабатывания, user_id, тип события, subscription_end)
+        self._heap: List[Tuple[int, int, str, int]] = []
+        # Актуальный subscription_end по пользователю; записи heap с другим
+        # значением считаются устаревшими и пропускаются
+        self._deadlines: Dict[int, int] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Момент начала последней загрузки или сверки с базой (UTC epoch)
+        self._synced_at: Optional[int] = None
+
+    @property
+    def scheduled_count(self) -> int:
+        """Количество пользователей с запланированным окончанием подписки"""
+        return len(self._deadlines)
+
+    def schedule(self, user_id: int, label: Optional[str], subscription_end: Optional[int]) -> None:
+        """
+        Обновляет срок окончания подписки пользователя
+
+        Args:
+            user_id (int): ID пользователя
+            label (str, optional): Новый label или None, если он не менялся
+            subscription_end (int, optional): Окончание подписки в UTC epoch
+        """
+        # Сроки нужны только запущенному планировщику (лидеру); остальные
+        # экземпляры не копят записи, которые некому обработать
+        if self._task is None:
+            return
+        if subscription_end is None or (label is not None and label not in PAID_LABELS):
+            self.unschedule(user_id)
+            return
+
+        if self._deadlines.get(user_id) == subscription_end:
+            return
+        self._deadlines[user_id] = subscription_end
+        heapq.heappush(self._heap, (subscription_end - REMINDER_BEFORE, user_id, KIND_REMIND, subscription_end))
+        heapq.heappush(self._heap, (subscription_end, user_id, KIND_EXPIRE, subscription_end))
+        self._wakeup.set()
+
+    def unschedule(self, user_id: int) -> None:
+        """Снимает пользователя с расписания (записи в heap удаляются лениво)"""
+        self._deadlines.pop(user_id, None)
+
+    async def load(self) -> int:
+        """Загружает сроки всех платных подписок из базы и возвращает их количество"""
+        self._synced_at = now_timestamp()
+        subscriptions = await self.db.classify_subscriptions(REMINDER_BEFORE)
+        for user in subscriptions:
+            self.schedule(user["user_id"], user["label"], user["subscription_end"])
+        return len(subscriptions)
+
+    async def sync(self) -> int:
+        """
+        Подхватывает подписки, измененные другими экземплярами бота после прошлой сверки
+
+        Returns:
+            int: Количество прочитанных изменений
+        """
+        if self._task is None or self._synced_at is None:
+            return 0
+        # updated_at хранится с точностью до секунды: секунду начала прошлой
+        # сверки читаем повторно, schedule для неизменившихся сроков ничего не делает
+        since, self._synced_at = self._synced_at, now_timestamp()
+        changes = await self.db.get_changed_subscriptions(since)
+        for user in changes:
+            self.schedule(user["user_id"], user["label"], user["subscription_end"])
+        return len(changes)
+
+    async def start(self) -> None:
+        """Запускает планировщик и загружает сроки"""
+        if self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+        count = await self.load()
+        logging.info(f"Загружено сроков подписок в планировщик: {count}")
+
+    async def stop(self) -> None:
+        """Останавливает планировщик"""
+        if self._task:
+            # Задача снимается до отмены: если wait_for поглотит отмену
+            # (пробуждение пришло одновременно с ней), цикл завершится сам
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        # Следующий лидер загрузит сроки заново
+        self._heap.clear()
+        self._deadlines.clear()
+        self._synced_at = None
+
+    async def _run(self):
+        """Основной цикл: обрабатывает наступившие сроки и спит до следующего"""
+        while self._task is asyncio.current_task():
+            now = now_timestamp()
+            if self._heap and self._heap[0][0] <= now:
+                with JOB_SECONDS.time(job="expiry_sweep"):
+                    await self._process_due(now)
+
+            timeout = min(self._heap[0][0] - now, MAX_SLEEP) if self._heap else MAX_SLEEP
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process_due(self, now: int) -> None:
+        """Обрабатывает все события, срок которых наступил к now"""
+        while self._heap and self._heap[0][0] <= now:
+            _, user_id, kind, subscription_end = heapq.heappop(self._heap)
+            if self._deadlines.get(user_id) != subscription_end:
+                continue
+            try:
+                if kind == KIND_REMIND:
+                    await self._remind(user_id, subscription_end)
+                else:
+                    await self._expire(user_id, subscription_end)
+            except Exception as e:
+                logging.error(f"Ошибка при обработке срока подписки пользователя {user_id}: {e}")
+
+    async def _is_current(self, user_id: int, subscription_end: int) -> bool:
+        """Проверяет по базе, что событие относится к действующей платной подписке"""
+        # Подписку могла изменить другая копия бота, поэтому читаем в обход кеша
+        user = await self.db.get_user(user_id, fresh=True)
+        if not user or user["label"] not in PAID_LABELS or user["subscription_end"] != subscription_end:
+            self.unschedule(user_id)
+            if user and user["label"] in PAID_LABELS:
+                self.schedule(user_id, user["label"], user["subscription_end"])
+            return False
+        return True
+
+    async def _remind(self, user_id: int, subscription_end: int) -> None:
+        """Отправляет напоминание о скором окончании подписки"""
+        seconds_left = subscription_end - now_timestamp()
+        if seconds_left <= 0 or not await self._is_current(user_id, subscription_end):
+            return
+
+        minutes_left = seconds_left // 60
+        logging.info(f"Отправляем уведомление пользователю {user_id} (осталось {minutes_left} минут)")
+        self.outbox.send_message(
+            user_id,
+            f"⚠️ Внимание! Ваша подписка истекает через {minutes_left} минут.\n"
+            "Чтобы продлить подписку, нажмите кнопку ниже:",
+            PRIORITY_BULK,
+            reply_markup=get_subscription_keyboard()
+        )
+
+    async def _expire(self, user_id: int, subscription_end: int) -> None:
+        """Завершает подписку: снимает платный label и удаляет пользователя из канала"""
+        # Одновременная оплата или продление администратором не должны потеряться
+        async with self.db.user_lock(user_id):
+            if not await self._is_current(user_id, subscription_end):
+                return
+            self.unschedule(user_id)
+
+            if not await self.db.expire_subscription(user_id):
+                return
+        logging.info(f"Подписка истекла для пользователя {user_id}")
+
+        if not self.channel_manager.channel_id:
+            return
+        if await self.channel_manager.check_user_subscription(user_id):
+            if await self.channel_manager.remove_user(user_id):
+                logging.info(f"Пользователь {user_id} удален из канала (истекла подписка)")
+                self.outbox.send_message(
+                    user_id,
+                    "❌ Ваша подписка истекла. Вы были удалены из канала. "
+                    "Для возобновления доступа, пожалуйста, продлите подписку.",
+                    PRIORITY_BULK
+                )
@@ -0,0 +1,162 @@
+"""
+Локальная замена Telegram Bot API для нагрузочных тестов (см. benchmark.py).
+
+Отвечает на методы, которыми пользуется бот, отдает через getUpdates
+обновления, подложенные тестом, и считает вызовы по методам и чатам.
+Бот подключается к нему через TELEGRAM_API_URL.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+from aiohttp import web
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+# Самый долгий getUpdates, который держит сервер, секунд
+MAX_POLL_TIMEOUT = 1.0
+# Предельный размер запроса (картинки загружаются целиком)
+MAX_REQUEST_SIZE = 50 * 1024 * 1024
+
+
+class FakeTelegramServer:
+    """Фейковый Bot API: aiohttp-приложение с журналом вызовов"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """
+        Args:
+            host (str): Адрес сервера
+            port (int): Порт (0 - любой свободный)
+        """
+        self.host = host
+        self.port = port
+        self.calls: Counter = Counter()
+        # Последние параметры исходящих сообщений по чатам
+        self.sent: Dict[int, List[Dict]] = defaultdict(list)
+        self._updates: List[Dict] = []
+        self._has_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self.app = web.Application(client_max_size=MAX_REQUEST_SIZE)
+        self.app.router.add_post("/bot{token}/{method}", self._handle)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # Обновления, которые тест отдает боту
+
+    @staticmethod
+    def user(user_id: int) -> Dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    @staticmethod
+    def private_chat(chat_id: int) -> Dict:
+        return {"id": chat_id, "type": "private"}
+
+    def push_command(self, user_id: int, command: str) -> None:
+        """Кладет в очередь сообщение с командой, например "/start" """
+        self._push({"message": {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self.private_chat(user_id),
+            "from": self.user(user_id),
+            "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command.split()[0])}]
+        }})
+
+    def push_callback(self, user_id: int, data: str) -> None:
+        """Кладет в очередь нажатие кнопки под последним сообщением бота в чате"""
+        self._push({"callback_query": {
+            "id": str(next(self._update_ids)),
+            "from": self.user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": self._message(user_id, {"text": "..."})
+        }})
+
+    def _push(self, update: Dict) -> None:
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self._has_updates.set()
+
+    async def _get_updates(self, params: Dict) -> List[Dict]:
+        offset = int(params.get("offset", 0))
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates:
+            self._has_updates.clear()
+            timeout = min(float(params.get("timeout", 0)), MAX_POLL_TIMEOUT)
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        limit = int(params.get("limit", 100))
+        return self._updates[:limit]
+
+    # Ответы на методы Bot API
+
+    def _message(self, chat_id: int, extra: Dict) -> Dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self.private_chat(chat_id),
+            "from": BOT_USER,
+            **extra
+        }
+
+    def _photo(self, params: Dict) -> List[Dict]:
+        # Загруженный файл получает новый file_id, переданный file_id возвращается как есть
+        photo = params.get("photo")
+        file_id = photo if isinstance(photo, str) else f"photo{next(self._file_ids)}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 600}]
+
+    async def _result(self, method: str, params: Dict):
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "getMe":
+            return BOT_USER
+        chat_id = int(params["chat_id"]) if str(params.get("chat_id", "")).lstrip("-").isdigit() else 0
+        if method in ("sendMessage", "editMessageText"):
+            self.sent[chat_id].append(params)
+            return self._message(chat_id, {"text": params.get("text", "")})
+        if method == "sendPhoto":
+            self.sent[chat_id].append({k: v for k, v in params.items() if k != "photo"})
+            return self._message(chat_id, {"photo": self._photo(params), "caption": params.get("caption")})
+        if method == "getChatMember":
+            return {"status": "member", "user": self.user(int(params["user_id"]))}
+        if method == "getChat":
+            return {"id": chat_id, "type": "channel", "title": "Bench channel"}
+        if method == "getChatMemberCount":
+            return 0
+        # answerCallbackQuery, deleteMessage, banChatMember, unbanChatMember, deleteWebhook и т.п.
+        return True
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        return web.json_response({"ok": True, "result": await self._result(method, params)})
+
+    def find_url(self, chat_id: int, prefix: str) -> Optional[str]:
+        """Последняя ссылка с началом prefix в кнопках сообщений, отправленных в чат"""
+        for params in reversed(self.sent.get(chat_id, [])):
+            markup = json.loads(params.get("reply_markup") or "{}")
+            for row in markup.get("inline_keyboard", []):
+                for button in row:
+                    if button.get("url", "").startswith(prefix):
+                        return button["url"]
+        return None
@@ -0,0 +1,112 @@
+"""
+Локальная замена API ЮMoney для нагрузочных тестов (см. benchmark.py).
+
+Отдает account-info и operation-history, а форма QuickPay сразу
+записывает успешный входящий перевод с переданными label и суммой,
+как будто пользователь оплатил ссылку. Бот подключается к нему через
+YOOMONEY_API_URL.
+"""
+import datetime
+import itertools
+from collections import Counter
+from typing import Dict, List, Optional
+from aiohttp import web
+
+ACCOUNT = "4100100000000"
+
+
+class FakeYooMoneyServer:
+    """Фейковый API ЮMoney: aiohttp-приложение с историей операций в памяти"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """
+        Args:
+            host (str): Адрес сервера
+            port (int): Порт (0 - любой свободный)
+        """
+        self.host = host
+        self.port = port
+        self.calls: Counter = Counter()
+        # Операции от новых к старым, как их отдает ЮMoney
+        self.operations: List[Dict] = []
+        self._operation_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self.app = web.Application()
+        self.app.router.add_post("/api/account-info", self._account_info)
+        self.app.router.add_post("/api/operation-history", self._operation_history)
+        self.app.router.add_route("*", "/quickpay/confirm.xml", self._quickpay)
+
+    @property
+    def api_url(self) -> str:
+        return f"http://{self.host}:{self.port}/api/"
+
+    @property
+    def quickpay_url(self) -> str:
+        return f"http://{self.host}:{self.port}/quickpay/confirm.xml"
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def add_payment(self, label: str, amount: float) -> Dict:
+        """Записывает успешный входящий перевод"""
+        operation = {
+            "operation_id": f"bench{next(self._operation_ids)}",
+            "status": "success",
+            "datetime": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "title": f"Перевод {label}",
+            "direction": "in",
+            "amount": amount,
+            "label": label,
+            "type": "deposition"
+        }
+        self.operations.insert(0, operation)
+        return operation
+
+    async def _account_info(self, request: web.Request) -> web.Response:
+        self.calls["account-info"] += 1
+        return web.json_response({
+            "account": ACCOUNT,
+            "balance": sum(operation["amount"] for operation in self.operations),
+            "currency": "643",
+            "account_status": "identified",
+            "account_type": "personal"
+        })
+
+    async def _operation_history(self, request: web.Request) -> web.Response:
+        self.calls["operation-history"] += 1
+        params = await request.post()
+        operations = self.operations
+        if params.get("type") == "deposition":
+            operations = [operation for operation in operations if operation["direction"] == "in"]
+        if params.get("label"):
+            operations = [operation for operation in operations if operation["label"] == params["label"]]
+        if params.get("from"):
+            # Даты в запросе - локальное время бота, в операциях - UTC
+            since = datetime.datetime.fromisoformat(params["from"]).astimezone(datetime.timezone.utc)
+            operations = [
+                operation for operation in operations
+                if datetime.datetime.fromisoformat(operation["datetime"].replace("Z", "+00:00")) >= since
+            ]
+        start = int(params.get("start_record", 0))
+        records = int(params.get("records", 30))
+        page = operations[start:start + records]
+        result = {"operations": page}
+        if start + records < len(operations):
+            result["next_record"] = str(start + records)
+        return web.json_response(result)
+
+    async def _quickpay(self, request: web.Request) -> web.Response:
+        self.calls["quickpay"] += 1
+        params = {**request.query, **(await request.post())}
+        if params.get("receiver") != ACCOUNT or not params.get("label"):
+            return web.Response(status=400, text="bad quickpay form")
+        self.add_payment(params["label"], float(params.get("sum", 0)))
+        return web.Response(text="ok")
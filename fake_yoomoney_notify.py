@@ -0,0 +1,65 @@
+"""
+Локальный отправитель тестовых уведомлений ЮMoney.
+
+Формирует уведомление о входящем переводе, подписывает его секретом так же,
+как ЮMoney, и отправляет на адрес бота:
+
+    python fake_yoomoney_notify.py --label 123456_sub_basic --amount 90
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import uuid
+import aiohttp
+from dotenv import load_dotenv
+from payment_notifications import sign_notification
+
+
+def build_notification(label: str, amount: float, secret: str, sender: str = "41001000040") -> dict:
+    """Собирает подписанное уведомление p2p-incoming"""
+    data = {
+        "notification_type": "p2p-incoming",
+        "operation_id": uuid.uuid4().hex,
+        "amount": f"{amount:.2f}",
+        "withdraw_amount": f"{amount:.2f}",
+        "currency": "643",
+        "datetime": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "sender": sender,
+        "codepro": "false",
+        "label": label,
+        "unaccepted": "false"
+    }
+    data["sha1_hash"] = sign_notification(data, secret)
+    return data
+
+
+async def send(url: str, data: dict) -> None:
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=data) as response:
+            print(f"{response.status} {await response.text()}")
+
+
+def main():
+    load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+    port = os.getenv('SERVICE_HTTP_PORT', '8081')
+    path = os.getenv('YOOMONEY_NOTIFICATION_PATH', '/yoomoney/notification')
+
+    parser = argparse.ArgumentParser(description="Отправка тестового уведомления ЮMoney")
+    parser.add_argument("--label", required=True, help="label оплаты, например 123456_sub_basic")
+    parser.add_argument("--amount", type=float, default=90)
+    parser.add_argument("--url", default=f"http://127.0.0.1:{port}{path}")
+    parser.add_argument("--secret", default=os.getenv('YOOMONEY_NOTIFICATION_SECRET'))
+    parser.add_argument("--bad-hash", action="store_true", help="испортить подпись")
+    args = parser.parse_args()
+    if not args.secret:
+        parser.error("нужен --secret или YOOMONEY_NOTIFICATION_SECRET")
+
+    data = build_notification(args.label, args.amount, args.secret)
+    if args.bad_hash:
+        data["sha1_hash"] = "0" * 40
+    asyncio.run(send(args.url, data))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
 import asyncio
 import logging
-from aiogram import Bot
+from typing import Iterable, Optional
+from aiogram import Bot, types
 from aiogram.exceptions import TelegramBadRequest
 import datetime
+from database import Database, NOT_MEMBER_STATUSES
+
+# Сколько запросов get_chat_member в секунду допускается при сверке с каналом
+RECONCILE_RATE = 5
 
 # Функции для работы с каналом
 async def check_user_channel_subscription(bot: Bot, channel_id: str, user_id: int) -> bool:
@@ -23,55 +28,117 @@ async def remove_user_from_channel(bot: Bot, channel_id: str, user_id: int) -> b
         logging.error(f"Ошибка при удалении пользователя {user_id} из канала: {e}")
         return False
 
-async def check_and_remove_expired_users(bot: Bot, channel_id: str, db):
-    """Проверяет и удаляет пользователей с истекшей подпиской из канала"""
-    while True:
-        try:
-            # Получаем пользователей с истекшей подпиской
-            expired_users = await db.get_expired_subscriptions()
-            
-            for user in expired_users:
-                # Проверяем, есть ли пользователь в канале
-                if await check_user_channel_subscription(bot, channel_id, user['user_id']):
-                    # Удаляем пользователя из канала
-                    if await remove_user_from_channel(bot, channel_id, user['user_id']):
-                        logging.info(f"Пользователь {user['user_id']} удален из канала (истекла подписка)")
-                        try:
-                            # Уведомляем пользователя
-                            await bot.send_message(
-                                user['user_id'],
-                                "❌ Ваша подписка истекла. Вы были удалены из канала. "
-                                "Для возобновления доступа, пожалуйста, продлите подписку."
-                            )
-                        except Exception as e:
-                            logging.error(f"Не удалось отправить уведомление пользователю {user['user_id']}: {e}")
-        
-        except Exception as e:
-            logging.error(f"Ошибка при проверке истекших подписок: {e}")
-        
-        # Проверяем каждый час
-        await asyncio.sleep(3600)
-
 # Класс для управления каналом
 class ChannelManager:
-    def __init__(self, bot: Bot, channel_id: str):
+    """
+    Управление каналом и учет его участников.
+
+    Статусы участников хранятся в таблице channel_members и обновляются из
+    обновлений chat_member (их может получить любой экземпляр бота), поэтому
+    проверка членства - это поиск по первичному ключу в локальной базе.
+    get_chat_member вызывается только для пользователей, о которых бот еще
+    ничего не знает (холодный старт), и при явной сверке.
+    """
+
+    def __init__(self, bot: Bot, channel_id: str, db: Database):
         self.bot = bot
         self.channel_id = channel_id
+        self.db = db
+        self._reconcile_task: Optional[asyncio.Task] = None
 
-    async def check_user_subscription(self, user_id: int) -> bool:
-        """Проверяет, подписан ли пользователь на канал"""
+    async def load(self) -> None:
+        """Запускает сверку для пользователей с неизвестным статусом"""
+        if not self.channel_id:
+            return
+        unknown = await self.db.get_users_without_channel_status()
+        if unknown and (self._reconcile_task is None or self._reconcile_task.done()):
+            self._reconcile_task = asyncio.create_task(self.reconcile(unknown))
+
+    async def stop(self) -> None:
+        """Останавливает сверку, если она еще идет"""
+        if self._reconcile_task:
+            self._reconcile_task.cancel()
+            try:
+                await self._reconcile_task
+            except asyncio.CancelledError:
+                pass
+            self._reconcile_task = None
+
+    async def reconcile(self, user_ids: Iterable[int]) -> int:
+        """
+        Запрашивает статусы пользователей через API и сохраняет их
+
+        Returns:
+            int: Количество проверенных пользователей
+        """
+        count = 0
+        for user_id in user_ids:
+            await self._probe(user_id)
+            count += 1
+            await asyncio.sleep(1 / RECONCILE_RATE)
+        logging.info(f"Сверка участников канала завершена, проверено пользователей: {count}")
+        return count
+
+    async def _probe(self, user_id: int) -> Optional[str]:
+        """Получает статус пользователя через get_chat_member"""
         try:
             member = await self.bot.get_chat_member(chat_id=self.channel_id, user_id=user_id)
-            return member.status not in ['left', 'kicked', 'banned']
+            status = self.member_status(member)
         except TelegramBadRequest:
-            return False
+            status = "left"
+        except Exception as e:
+            logging.error(f"Ошибка при проверке пользователя {user_id} в канале: {e}")
+            return None
+        await self._set_status(user_id, status)
+        return status
+
+    @staticmethod
+    def member_status(member: types.ChatMember) -> str:
+        """Статус участника для базы: ограниченный участник, вышедший из канала, считается вышедшим"""
+        if member.status == "restricted" and not member.is_member:
+            return "left"
+        return member.status
+
+    async def _set_status(self, user_id: int, status: str) -> None:
+        """Сохраняет статус пользователя в базе"""
+        await self.db.set_channel_member_status(user_id, status)
+
+    def is_channel(self, chat_id: int) -> bool:
+        """Проверяет, что chat_id - это наш канал"""
+        return bool(self.channel_id) and str(chat_id) == str(self.channel_id)
+
+    async def on_chat_member(self, update: types.ChatMemberUpdated) -> None:
+        """Обработчик обновлений chat_member: сохраняет новый статус участника"""
+        if not self.is_channel(update.chat.id):
+            return
+        user_id = update.new_chat_member.user.id
+        status = self.member_status(update.new_chat_member)
+        try:
+            await self._set_status(user_id, status)
+            logging.info(f"Статус пользователя {user_id} в канале: {status}")
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении статуса пользователя {user_id} в канале: {e}")
+
+    async def check_user_subscription(self, user_id: int) -> bool:
+        """Проверяет, подписан ли пользователь на канал"""
+        status = await self.db.get_channel_member_status(user_id)
+        if status is None:
+            status = await self._probe(user_id)
+            if status is None:
+                return False
+        return status not in NOT_MEMBER_STATUSES
+
+    async def count_unpaid_members(self) -> int:
+        """Количество пользователей в канале без действующей подписки"""
+        return await self.db.count_unpaid_channel_members()
 
     async def remove_user(self, user_id: int) -> bool:
         """Удаляет пользователя из канала"""
         try:
             await self.bot.ban_chat_member(chat_id=self.channel_id, user_id=user_id)
             await self.bot.unban_chat_member(chat_id=self.channel_id, user_id=user_id)  # Разбаниваем, чтобы пользователь мог вернуться
+            await self._set_status(user_id, "left")
             return True
         except Exception as e:
             logging.error(f"Ошибка при удалении пользователя {user_id} из канала: {e}")
-            return False 
\ No newline at end of file
+            return False
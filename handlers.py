@@ -1,15 +1,17 @@
 import logging
 from aiogram import Bot, types
 from aiogram.filters import Command
-from aiogram.types import Message, FSInputFile
-from yoomoney import Client
+from aiogram.types import Message
+from yoomoney_api import YooMoneyClient
 
 from keyboards import get_main_keyboard, get_subscription_keyboard
+from media import MediaRegistry
 
 class MessageHandler:
-    def __init__(self, bot: Bot, yoomoney_client: Client):
+    def __init__(self, bot: Bot, yoomoney_client: YooMoneyClient, media: MediaRegistry):
         self.bot = bot
         self.yoomoney_client = yoomoney_client
+        self.media = media
 
     async def process_subscribe_button(self, callback_query: types.CallbackQuery):
         """Обработчик нажатия кнопки 'Подписки'"""
@@ -17,9 +19,9 @@ class MessageHandler:
         await callback_query.message.delete()
         
         # Отправляем сообщение с описанием и кнопками
-        photo = FSInputFile("imgs/2.png")
-        await callback_query.message.answer_photo(
-            photo=photo,
+        await self.media.send_photo(
+            callback_query.message.answer_photo,
+            "imgs/2.png",
             caption=(
                 "*Подписка - это не доступ. Это выбор стороны.* 🔓\n\n"
                 "Либо ты как все - тыкаешь наугад, сливаешь, ищешь виноватых.\n"
@@ -46,7 +48,7 @@ class MessageHandler:
     async def cmd_balance(self, message: Message):
         """Обработчик команды /balance"""
         try:
-            user = self.yoomoney_client.account_info()
+            user = await self.yoomoney_client.account_info()
             await message.answer(f"Ваш баланс: {user.balance} {user.currency}")
         except Exception as e:
             logging.error(f"Ошибка при получении баланса: {e}")
@@ -0,0 +1,45 @@
+import logging
+from typing import Awaitable, Callable
+from aiohttp import web
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+class HttpServer:
+    """
+    Встроенный HTTP-сервер для служебных адресов бота (уведомления ЮMoney и т.п.).
+
+    Маршруты добавляются до запуска; если их нет, сервер не запускается.
+    """
+
+    def __init__(self, host: str, port: int):
+        """
+        Args:
+            host (str): Адрес, на котором слушает сервер
+            port (int): Порт сервера
+        """
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self._routes = 0
+        self._runner: web.AppRunner = None
+
+    def add_route(self, method: str, path: str, handler: Handler) -> None:
+        """Добавляет маршрут"""
+        self.app.router.add_route(method, path, handler)
+        self._routes += 1
+
+    async def start(self) -> None:
+        """Запускает сервер, если есть маршруты"""
+        if not self._routes or self._runner is not None:
+            return
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info(f"Служебный HTTP-сервер запущен на {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        """Останавливает сервер"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -1,4 +1,6 @@
+from typing import Optional
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from callback_router import TariffCallback, AdminExtendCallback, AdminCancelCallback, AdminSubscribersCallback
 
 # Главное меню
 def get_main_keyboard(is_admin: bool = False) -> InlineKeyboardMarkup:
@@ -26,9 +28,9 @@ def get_subscription_keyboard() -> InlineKeyboardMarkup:
     """Создает клавиатуру с тарифами подписок"""
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="🔹 День - 90₽", callback_data="sub_basic")],
-            [InlineKeyboardButton(text="🔹 Неделя - 440₽", callback_data="sub_standard")],
-            [InlineKeyboardButton(text="🔹 Месяц - 1620₽", callback_data="sub_premium")],
+            [InlineKeyboardButton(text="🔹 День - 90₽", callback_data=TariffCallback(code="sub_basic").pack())],
+            [InlineKeyboardButton(text="🔹 Неделя - 440₽", callback_data=TariffCallback(code="sub_standard").pack())],
+            [InlineKeyboardButton(text="🔹 Месяц - 1620₽", callback_data=TariffCallback(code="sub_premium").pack())],
             [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_payment")]
         ]
     )
@@ -67,23 +69,23 @@ def get_subscription_management_keyboard(user_id: int) -> InlineKeyboardMarkup:
             [
                 InlineKeyboardButton(
                     text="➕ Продлить на день",
-                    callback_data=f"admin_extend_{user_id}_day"
+                    callback_data=AdminExtendCallback(user_id=user_id, period="day").pack()
                 ),
                 InlineKeyboardButton(
                     text="❌ Отменить подписку",
-                    callback_data=f"admin_cancel_{user_id}"
+                    callback_data=AdminCancelCallback(user_id=user_id).pack()
                 )
             ],
             [
                 InlineKeyboardButton(
                     text="➕ Продлить на неделю",
-                    callback_data=f"admin_extend_{user_id}_week"
+                    callback_data=AdminExtendCallback(user_id=user_id, period="week").pack()
                 )
             ],
             [
                 InlineKeyboardButton(
                     text="➕ Продлить на месяц",
-                    callback_data=f"admin_extend_{user_id}_month"
+                    callback_data=AdminExtendCallback(user_id=user_id, period="month").pack()
                 )
             ],
             [
@@ -93,4 +95,40 @@ def get_subscription_management_keyboard(user_id: int) -> InlineKeyboardMarkup:
                 )
             ]
         ]
-    ) 
\ No newline at end of file
+    ) 
+
+# Фильтры списка подписчиков: значение в callback_data и подпись кнопки
+SUBSCRIBER_FILTERS = {
+    "all": "Все",
+    "active": "✅ Активные",
+    "expired": "⚠️ Истекшие",
+    "basic": "❌ Без подписки"
+}
+
+def get_subscribers_keyboard(status: str, first_id: Optional[int], last_id: Optional[int],
+                             has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    """Возвращает клавиатуру страницы списка подписчиков с фильтрами и листанием"""
+    filters = [
+        InlineKeyboardButton(
+            text=("• " if code == status else "") + title,
+            callback_data=AdminSubscribersCallback(status=code, cursor=0, backwards=False).pack()
+        )
+        for code, title in SUBSCRIBER_FILTERS.items()
+    ]
+    navigation = []
+    if has_prev and first_id is not None:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ Назад",
+            callback_data=AdminSubscribersCallback(status=status, cursor=first_id, backwards=True).pack()
+        ))
+    if has_next and last_id is not None:
+        navigation.append(InlineKeyboardButton(
+            text="Вперед ➡️",
+            callback_data=AdminSubscribersCallback(status=status, cursor=last_id, backwards=False).pack()
+        ))
+
+    keyboard = [filters[:2], filters[2:]]
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton(text="🔙 Админ-панель", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
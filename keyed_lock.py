@@ -0,0 +1,42 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, List
+
+
+class KeyedLock:
+    """
+    Набор asyncio.Lock по ключу (обычно user_id).
+
+    Операции с одним ключом выполняются по очереди, с разными - параллельно.
+    Замок создается при первом обращении и удаляется, когда его больше никто
+    не ждет, поэтому словарь не растет с числом пользователей. Замок не
+    реентерабельный: внутри блока нельзя снова брать тот же ключ того же
+    экземпляра KeyedLock.
+    """
+
+    def __init__(self):
+        # Замок и количество задач, которые его держат или ждут
+        self._locks: Dict[Hashable, List] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def locked(self, key: Hashable) -> bool:
+        """Занят ли ключ"""
+        entry = self._locks.get(key)
+        return entry is not None and entry[0].locked()
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable):
+        """Блок with, выполняемый монопольно для key"""
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+import secrets
+import socket
+from typing import Awaitable, Callable, Optional
+from database import Database
+
+# Срок аренды: если лидер не продлил ее за это время, ее забирает другой экземпляр
+LEASE_TTL = 30
+# Как часто лидер продлевает аренду, а остальные пытаются ее получить
+RENEW_INTERVAL = 10
+# Как часто лидер подхватывает изменения, сделанные другими экземплярами
+SYNC_INTERVAL = 60
+
+
+class LeaderElection:
+    """
+    Выбор единственного экземпляра бота для фоновых задач.
+
+    Лидерство - это строка в таблице leases с временем истечения. Лидер
+    продлевает ее каждые RENEW_INTERVAL секунд; если он завис или упал, через
+    LEASE_TTL аренду получает другой экземпляр. Обработку обновлений Telegram
+    выполняют все экземпляры, а напоминания, отключение подписок и опрос
+    оплат - только лидер.
+    """
+
+    def __init__(self, db: Database,
+                 on_elected: Callable[[], Awaitable[None]],
+                 on_demoted: Callable[[], Awaitable[None]],
+                 on_sync: Optional[Callable[[], Awaitable[None]]] = None,
+                 name: str = "background",
+                 ttl: float = LEASE_TTL,
+                 renew_interval: float = RENEW_INTERVAL,
+                 sync_interval: float = SYNC_INTERVAL):
+        """
+        Args:
+            db (Database): База данных, в которой хранится аренда
+            on_elected: Корутина, запускающая фоновые задачи
+            on_demoted: Корутина, останавливающая фоновые задачи
+            on_sync: Корутина, которую лидер вызывает раз в sync_interval
+            name (str): Имя аренды
+            ttl (float): Срок аренды в секундах
+            renew_interval (float): Интервал продления в секундах
+            sync_interval (float): Интервал вызова on_sync в секундах
+        """
+        self.db = db
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.on_sync = on_sync
+        self.name = name
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.sync_interval = sync_interval
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Запускает участие в выборах"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает фоновые задачи и освобождает аренду"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            await self._demote()
+            try:
+                await self.db.release_lease(self.name, self.holder)
+            except Exception as e:
+                logging.error(f"Ошибка при освобождении аренды {self.name}: {e}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_sync = 0.0
+        while True:
+            try:
+                acquired = await self.db.acquire_lease(self.name, self.holder, self.ttl)
+            except Exception as e:
+                logging.error(f"Ошибка при продлении аренды {self.name}: {e}")
+                acquired = False
+
+            if acquired and not self.is_leader:
+                logging.info(f"Экземпляр {self.holder} стал лидером ({self.name})")
+                self.is_leader = True
+                next_sync = loop.time() + self.sync_interval
+                try:
+                    await self.on_elected()
+                except Exception as e:
+                    logging.error(f"Ошибка при запуске фоновых задач лидера: {e}")
+            elif not acquired and self.is_leader:
+                logging.warning(f"Экземпляр {self.holder} потерял лидерство ({self.name})")
+                await self._demote()
+            elif self.is_leader and self.on_sync and loop.time() >= next_sync:
+                next_sync = loop.time() + self.sync_interval
+                try:
+                    await self.on_sync()
+                except Exception as e:
+                    logging.error(f"Ошибка при синхронизации состояния лидера: {e}")
+
+            await asyncio.sleep(self.renew_interval)
+
+    async def _demote(self) -> None:
+        self.is_leader = False
+        try:
+            await self.on_demoted()
+        except Exception as e:
+            logging.error(f"Ошибка при остановке фоновых задач лидера: {e}")
@@ -0,0 +1,182 @@
+"""
+Настройка логирования бота.
+
+Все записи проходят через QueueHandler: в цикле событий запись только кладется
+в очередь, а форматирование и запись на диск выполняет поток QueueListener.
+Файлы пишутся в JSON по строке на запись, ротируются по размеру или по времени
+и сжимаются gzip. Уровни задаются переменными окружения:
+
+    LOG_LEVEL=INFO
+    LOG_LEVELS=utils=WARNING,aiogram.event=WARNING,database=DEBUG
+
+В LOG_LEVELS указываются имена логгеров или модулей (для записей через
+logging.info в корне - имя файла без .py).
+"""
+import datetime
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+from typing import Dict, Optional
+from dotenv import load_dotenv
+
+ENV_PATH = os.path.join(os.path.dirname(__file__), '.env')
+
+# Основной лог и лог медленных обновлений (см. UpdateProfilingMiddleware)
+LOG_FILE = "bot.log"
+SLOW_LOG_LOGGER = "slow_updates"
+# Ротация по размеру, байт; при заданном LOG_ROTATE_WHEN - по времени (midnight, H, D, ...)
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 10
+
+# Атрибуты LogRecord, которые не считаются дополнительными полями записи
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись в виде одной строки JSON; поля из extra= попадают в нее как есть"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LevelFilter(logging.Filter):
+    """
+    Уровни по логгерам и модулям.
+
+    Для записи ищется самое точное совпадение по имени логгера (aiogram.event,
+    затем aiogram) или по имени модуля, иначе действует общий уровень.
+    """
+
+    def __init__(self, default: int, levels: Dict[str, int]):
+        super().__init__()
+        self.default = default
+        self.levels = levels
+
+    def level_for(self, record: logging.LogRecord) -> int:
+        name = record.name
+        while name:
+            if name in self.levels:
+                return self.levels[name]
+            name = name.rpartition(".")[0]
+        return self.levels.get(record.module, self.default)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= self.level_for(record)
+
+
+def parse_level(value: str, setting: str) -> int:
+    """
+    Переводит имя уровня ("INFO", "debug") или число в уровень logging
+
+    Raises:
+        ValueError: Неизвестный уровень (опечатка в настройке setting)
+    """
+    value = value.strip().upper()
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value)
+    # Для неизвестных имен getLevelName возвращает строку "Level ..."
+    if not isinstance(level, int):
+        raise ValueError(f"Неизвестный уровень логирования {value!r} в {setting}")
+    return level
+
+
+def parse_levels(value: str) -> Dict[str, int]:
+    """Разбирает строку вида "utils=WARNING,aiogram=INFO" """
+    levels = {}
+    for item in value.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = parse_level(level, "LOG_LEVELS")
+    return levels
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def rotating_handler(path: str, max_bytes: int, backup_count: int,
+                     when: Optional[str] = None) -> logging.Handler:
+    """Файловый обработчик с ротацией по размеру (или по времени при when) и сжатием старых файлов"""
+    if when:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path, when=when, backupCount=backup_count, encoding="utf-8", delay=True
+        )
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True
+        )
+    handler.namer = lambda name: name + ".gz"
+    handler.rotator = _gzip_rotator
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    Настраивает логирование по переменным окружения (.env подгружается здесь,
+    чтобы настройки действовали уже при импорте бота)
+
+    Returns:
+        QueueListener: Запущенный поток записи; его нужно остановить при выходе,
+            чтобы дописать очередь
+
+    Raises:
+        ValueError: В LOG_LEVEL или LOG_LEVELS указан неизвестный уровень
+    """
+    load_dotenv(ENV_PATH)
+    default_level = parse_level(os.getenv("LOG_LEVEL", "INFO"), "LOG_LEVEL")
+    levels = parse_levels(os.getenv("LOG_LEVELS", ""))
+    max_bytes = int(os.getenv("LOG_MAX_BYTES", str(LOG_MAX_BYTES)))
+    backup_count = int(os.getenv("LOG_BACKUP_COUNT", str(LOG_BACKUP_COUNT)))
+    when = os.getenv("LOG_ROTATE_WHEN") or None
+
+    log_file = os.getenv("LOG_FILE", LOG_FILE)
+    if log_file:
+        handlers = [rotating_handler(log_file, max_bytes, backup_count, when)]
+    else:
+        # Пустой LOG_FILE - JSON в stderr (например, в контейнере)
+        handlers = [logging.StreamHandler()]
+        handlers[0].setFormatter(JsonFormatter())
+    # Медленные обновления дополнительно пишутся в свой файл
+    slow_log_file = os.getenv("SLOW_UPDATE_LOG")
+    if slow_log_file:
+        slow_handler = rotating_handler(slow_log_file, max_bytes, backup_count, when)
+        slow_handler.addFilter(logging.Filter(SLOW_LOG_LOGGER))
+        handlers.append(slow_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(LevelFilter(default_level, levels))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    # Корень пропускает самый подробный из заданных уровней, остальное отсекает LevelFilter
+    root.setLevel(min([default_level, *levels.values()]))
+    # Именованные логгеры не создают записи ниже своего уровня
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
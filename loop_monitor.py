@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+from metrics import LOOP_LAG, LOOP_STALLS
+
+# Блокировка цикла событий дольше этого порога считается зависанием, мс (0 - выключено)
+STALL_THRESHOLD_MS = 100
+# Как часто цикл отмечается, что он жив, секунд
+HEARTBEAT_INTERVAL = 0.05
+# Сколько последних кадров стека писать в лог
+STACK_LIMIT = 20
+
+
+class LoopStallMonitor:
+    """
+    Сторож цикла событий.
+
+    Задача в цикле раз в HEARTBEAT_INTERVAL отмечает время и пишет в метрики,
+    насколько ее пробуждение опоздало. Отдельный поток проверяет эту отметку:
+    если цикл молчит дольше порога, значит его держит синхронный код, и поток
+    снимает стек потока цикла прямо во время зависания. Стек и задача, которая
+    выполнялась, попадают в лог, зависание - в счетчик bot_event_loop_stalls_total.
+    """
+
+    def __init__(self, threshold_ms: float = STALL_THRESHOLD_MS, interval: float = HEARTBEAT_INTERVAL):
+        """
+        Args:
+            threshold_ms (float): Порог зависания в миллисекундах (0 - не запускать)
+            interval (float): Интервал отметок цикла в секундах
+        """
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat = 0.0
+        self._reported_heartbeat = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """Запускает отметки в текущем цикле и поток-сторож"""
+        if self.threshold <= 0 or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="loop-stall-monitor", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        """Останавливает сторожа"""
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    async def _beat(self):
+        """Отмечает, что цикл жив, и замеряет опоздание пробуждения"""
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            LOOP_LAG.observe(max(now - expected, 0.0))
+            self._heartbeat = now
+
+    def _watch(self):
+        """Поток-сторож: снимает стек цикла, если тот не отмечался дольше порога"""
+        while not self._stopped.wait(self.interval):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            # О каждом зависании сообщаем один раз
+            if blocked < self.threshold or heartbeat == self._reported_heartbeat:
+                continue
+            self._reported_heartbeat = heartbeat
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT)) if frame else "стек недоступен\n"
+            task = asyncio.current_task(self._loop)
+            coro = getattr(task.get_coro(), "__qualname__", "-") if task else "-"
+            logging.warning(
+                f"Цикл событий заблокирован уже {blocked * 1000:.0f} мс, "
+                f"задача: {task.get_name() if task else None} ({coro}), стек:\n{stack}"
+            )
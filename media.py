@@ -0,0 +1,111 @@
+import os
+import json
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Union
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+# Файл, в котором сохраняются file_id загруженных картинок
+MEDIA_CACHE_PATH = "media_cache.json"
+# Фрагменты текста ошибки Telegram, означающие, что отклонен сам file_id
+FILE_ID_ERRORS = ("wrong file identifier", "file_id")
+
+
+class MediaRegistry:
+    """
+    Реестр file_id статических картинок бота.
+
+    Каждая картинка загружается в Telegram один раз, полученный file_id
+    сохраняется на диск и используется при следующих отправках. Если файл
+    изменился или Telegram отклонил file_id, картинка загружается заново.
+    """
+
+    def __init__(self, cache_path: str = MEDIA_CACHE_PATH):
+        """
+        Args:
+            cache_path (str): Путь к JSON-файлу с сохраненными file_id
+        """
+        self.cache_path = cache_path
+        self._entries: Dict[str, Dict] = self._load()
+
+    def _load(self) -> Dict[str, Dict]:
+        """Читает сохраненные file_id"""
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"Ошибка при чтении кеша картинок {self.cache_path}: {e}")
+            return {}
+
+    def _save(self) -> None:
+        """Сохраняет file_id на диск"""
+        try:
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении кеша картинок {self.cache_path}: {e}")
+
+    @staticmethod
+    def _fingerprint(path: str) -> Dict:
+        """Размер и время изменения файла, по которым определяется его замена"""
+        stat = os.stat(path)
+        return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+    def get(self, path: str) -> Union[str, FSInputFile]:
+        """Возвращает file_id картинки или файл для загрузки, если file_id нет или он устарел"""
+        entry = self._entries.get(path)
+        if entry and entry.get("fingerprint") == self._fingerprint(path):
+            return entry["file_id"]
+        return FSInputFile(path)
+
+    def remember(self, path: str, message: Message) -> None:
+        """Запоминает file_id картинки из отправленного сообщения"""
+        if not message or not message.photo:
+            return
+        self._entries[path] = {
+            "file_id": message.photo[-1].file_id,
+            "fingerprint": self._fingerprint(path)
+        }
+        self._save()
+        logging.info(f"Картинка {path} загружена в Telegram, file_id сохранен")
+
+    def forget(self, path: str) -> None:
+        """Удаляет сохраненный file_id картинки"""
+        if self._entries.pop(path, None) is not None:
+            self._save()
+
+    @staticmethod
+    def is_file_id_error(error: TelegramBadRequest) -> bool:
+        """Отклонил ли Telegram именно file_id картинки"""
+        message = str(error.message).lower()
+        return any(fragment in message for fragment in FILE_ID_ERRORS)
+
+    async def send_photo(self, send: Callable[..., Awaitable[Message]], path: str, **kwargs) -> Optional[Message]:
+        """
+        Отправляет картинку, по возможности через сохраненный file_id
+
+        Args:
+            send: Метод отправки (bot.send_photo, message.answer_photo и т.п.)
+            path (str): Путь к картинке
+            **kwargs: Остальные параметры метода отправки
+        """
+        photo = self.get(path)
+        try:
+            message = await send(photo=photo, **kwargs)
+        except TelegramBadRequest as e:
+            # Ошибки подписи, клавиатуры, чата и т.п. к file_id не относятся
+            if not isinstance(photo, str) or not self.is_file_id_error(e):
+                raise
+            # Telegram не принял file_id - загружаем файл заново
+            logging.info(f"file_id картинки {path} отклонен ({e}), загружаем заново")
+            self.forget(path)
+            photo = FSInputFile(path)
+            message = await send(photo=photo, **kwargs)
+
+        if not isinstance(photo, str):
+            self.remember(path, message)
+        return message
@@ -0,0 +1,281 @@
+import bisect
+import functools
+import inspect
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from aiohttp import web
+
+# Границы корзин гистограмм по умолчанию, секунд
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    """Форматирует метки в виде {name="value",...}"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Базовый класс метрики с метками"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    """Текущее значение; может вычисляться функцией в момент выгрузки"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Значение без меток берется из function при каждой выгрузке"""
+        self._function = function
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(Metric):
+    """Распределение значений по корзинам (в основном длительностей)"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждой комбинации меток: счетчики корзин (последняя - +Inf) и сумма
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока with"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# Метрики бота
+HANDLER_SECONDS = histogram(
+    "bot_handler_duration_seconds", "Время обработки обновления", ("kind", "handler")
+)
+HANDLER_ERRORS = counter(
+    "bot_handler_errors_total", "Необработанные исключения в обработчиках", ("kind", "handler")
+)
+SLOW_UPDATES = counter(
+    "bot_slow_updates_total", "Обновления дольше порога SLOW_UPDATE_SECONDS", ("kind",)
+)
+DB_SECONDS = histogram(
+    "bot_db_query_duration_seconds", "Время выполнения методов Database", ("method",)
+)
+TELEGRAM_SECONDS = histogram(
+    "bot_telegram_request_duration_seconds", "Время запросов к Telegram Bot API", ("method",)
+)
+TELEGRAM_ERRORS = counter(
+    "bot_telegram_request_errors_total", "Ошибки запросов к Telegram Bot API", ("method", "error")
+)
+YOOMONEY_SECONDS = histogram(
+    "bot_yoomoney_request_duration_seconds", "Время запросов к API ЮMoney", ("method",)
+)
+YOOMONEY_ERRORS = counter(
+    "bot_yoomoney_request_errors_total", "Ошибки запросов к API ЮMoney", ("method", "error")
+)
+JOB_SECONDS = histogram(
+    "bot_background_job_duration_seconds", "Длительность проходов фоновых задач", ("job",),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+)
+LOOP_LAG = histogram(
+    "bot_event_loop_lag_seconds", "Опоздание пробуждения задачи-сторожа цикла событий",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+LOOP_STALLS = counter("bot_event_loop_stalls_total", "Блокировки цикла событий дольше порога LOOP_STALL_MS")
+OUTBOX_DEPTH = gauge("bot_outbox_depth", "Сообщения, ожидающие отправки")
+PENDING_PAYMENTS = gauge("bot_pending_payments", "Оплаты в опросе ЮMoney")
+
+
+# Время текущего обновления по внешним вызовам: {"db.get_user": [вызовов, секунд]}.
+# None вне обновления, тогда вызовы никуда не записываются
+_spans: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar("spans", default=None)
+# Внешний вызов, внутри которого мы находимся: вложенные вызовы не учитываются дважды
+_open_span: ContextVar[Optional[str]] = ContextVar("open_span", default=None)
+
+
+@contextmanager
+def collect_spans():
+    """Собирает внешние вызовы, сделанные внутри блока with (в той же задаче)"""
+    spans: Dict[str, List[float]] = {}
+    token = _spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _spans.reset(token)
+
+
+def record_span(name: str, seconds: float) -> None:
+    """Добавляет время внешнего вызова к текущему обновлению, если оно профилируется"""
+    spans = _spans.get()
+    if spans is None:
+        return
+    entry = spans.get(name)
+    if entry is None:
+        spans[name] = [1, seconds]
+    else:
+        entry[0] += 1
+        entry[1] += seconds
+
+
+def instrument_methods(cls: type, histogram_: Histogram, span: str) -> type:
+    """
+    Оборачивает публичные async-методы класса замером времени с меткой method.
+    Время также попадает в разбивку обновления как "{span}.{method}".
+    """
+    for name, function in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.isfunction(function) \
+                or not inspect.iscoroutinefunction(function):
+            continue
+
+        def wrap(function, name):
+            span_name = f"{span}.{name}"
+
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                token = _open_span.set(span_name) if _open_span.get() is None else None
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    histogram_.observe(elapsed, method=name)
+                    if token is not None:
+                        _open_span.reset(token)
+                        record_span(span_name, elapsed)
+            return wrapper
+
+        setattr(cls, name, wrap(function, name))
+    return cls
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Обработчик GET /metrics"""
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
@@ -0,0 +1,200 @@
+import cProfile
+import io
+import logging
+import pstats
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+from callback_router import CallbackRouter
+from keyed_lock import KeyedLock
+from metrics import (
+    HANDLER_ERRORS, HANDLER_SECONDS, SLOW_UPDATES, TELEGRAM_ERRORS, TELEGRAM_SECONDS, collect_spans, record_span
+)
+
+# Отдельный логгер, чтобы медленные обновления можно было писать в свой файл
+slow_log = logging.getLogger("slow_updates")
+
+# Группы внешних вызовов в разбивке времени обновления
+SPAN_GROUPS = ("db", "telegram", "yoomoney")
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Замеряет время обработки сообщений и callback-запросов.
+
+    Метка handler ограничена известными командами и маршрутами CallbackRouter,
+    чтобы произвольный ввод пользователей не плодил новые временные ряды.
+    """
+
+    def __init__(self, callback_router: CallbackRouter, commands: Iterable[str]):
+        """
+        Args:
+            callback_router (CallbackRouter): Маршрутизатор для имен callback-обработчиков
+            commands: Известные команды без "/" (например "start", "extend")
+        """
+        self.callback_router = callback_router
+        self.commands = frozenset(commands)
+
+    def handler_name(self, event: TelegramObject) -> str:
+        """Метка обработчика для события"""
+        if isinstance(event, CallbackQuery):
+            return self.callback_router.route_name(event.data)
+        if isinstance(event, Message):
+            text = event.text or ""
+            if not text.startswith("/"):
+                return "text"
+            # /extend_123@bot -> extend
+            command = text[1:].split(maxsplit=1)[0] if len(text) > 1 else ""
+            command = command.split("@", 1)[0]
+            base, _, suffix = command.partition("_")
+            if suffix.isdigit():
+                command = base
+            return f"/{command}" if command in self.commands else "/unknown"
+        return "other"
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        kind = "callback" if isinstance(event, CallbackQuery) else "message"
+        name = self.handler_name(event)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(kind=kind, handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, kind=kind, handler=name)
+
+
+class UserSerialMiddleware(BaseMiddleware):
+    """
+    Обрабатывает сообщения и нажатия одного пользователя по очереди.
+
+    Двойное нажатие или вторая кнопка, нажатая до ответа на первую, ждут
+    окончания предыдущего обработчика; обновления разных пользователей
+    по-прежнему обрабатываются параллельно.
+    """
+
+    def __init__(self):
+        self.locks = KeyedLock()
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        async with self.locks(user.id):
+            return await handler(event, data)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет время и ошибки запросов к Telegram Bot API по имени метода"""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            TELEGRAM_SECONDS.observe(elapsed, method=name)
+            record_span(f"telegram.{name}", elapsed)
+
+
+class UpdateProfilingMiddleware(BaseMiddleware):
+    """
+    Замеряет каждое обновление целиком и раскладывает время по внешним вызовам:
+    методам Database, запросам к Telegram Bot API и к ЮMoney.
+
+    Обновления дольше slow_threshold попадают в лог slow_updates вместе с командой
+    или callback data, user id и разбивкой времени. Доля profile_rate обновлений
+    дополнительно выполняется под cProfile, и их профиль тоже пишется в этот лог.
+    Профилировщик в потоке один, поэтому одновременно профилируется не больше
+    одного обновления, а в профиль попадают и задачи, выполнявшиеся параллельно.
+    """
+
+    def __init__(self, slow_threshold: float = 1.0, profile_rate: float = 0.0, profile_limit: int = 25):
+        """
+        Args:
+            slow_threshold (float): Порог медленного обновления, секунд (0 - не писать)
+            profile_rate (float): Доля обновлений, выполняемых под cProfile (0 - выключено)
+            profile_limit (int): Сколько строк профиля выводить
+        """
+        self.slow_threshold = slow_threshold
+        self.profile_rate = profile_rate
+        self.profile_limit = profile_limit
+        self._profiling = False
+
+    @staticmethod
+    def describe(update: Update) -> str:
+        """Команда или callback data обновления (произвольный текст не пишется в лог)"""
+        event = update.event
+        if isinstance(event, CallbackQuery):
+            return f"callback {event.data}"
+        if isinstance(event, Message):
+            text = event.text or ""
+            if text.startswith("/"):
+                return f"command {text.split(maxsplit=1)[0]}"
+            return "message"
+        return update.event_type
+
+    @staticmethod
+    def breakdown(spans: Dict[str, List[float]], total: float) -> str:
+        """Разбивка времени: итоги по группам, затем отдельные вызовы по убыванию времени"""
+        groups = {group: 0.0 for group in SPAN_GROUPS}
+        for name, (_, seconds) in spans.items():
+            group = name.split(".", 1)[0]
+            groups[group] = groups.get(group, 0.0) + seconds
+        parts = [f"{group}={seconds:.3f}" for group, seconds in groups.items()]
+        parts.append(f"other={max(total - sum(groups.values()), 0.0):.3f}")
+        calls = sorted(spans.items(), key=lambda item: item[1][1], reverse=True)
+        details = ", ".join(f"{name}x{int(count)}={seconds:.3f}" for name, (count, seconds) in calls)
+        return " ".join(parts) + (f" [{details}]" if details else "")
+
+    def _start_profile(self) -> Optional[cProfile.Profile]:
+        if self.profile_rate <= 0 or self._profiling or random.random() >= self.profile_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Профилировщик уже включен кем-то другим
+            return None
+        self._profiling = True
+        return profile
+
+    def _format_profile(self, profile: cProfile.Profile) -> str:
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(self.profile_limit)
+        return stream.getvalue()
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        profile = self._start_profile()
+        start = time.perf_counter()
+        with collect_spans() as spans:
+            try:
+                return await handler(event, data)
+            finally:
+                total = time.perf_counter() - start
+                if profile is not None:
+                    profile.disable()
+                    self._profiling = False
+                slow = 0 < self.slow_threshold <= total
+                if slow:
+                    SLOW_UPDATES.inc(kind=event.event_type)
+                if slow or profile is not None:
+                    user = data.get("event_from_user")
+                    profile_text = "\n" + self._format_profile(profile) if profile is not None else ""
+                    slow_log.warning(
+                        f"{'Медленное' if slow else 'Профилированное'} обновление {event.update_id}: "
+                        f"{self.describe(event)}, user_id={user.id if user else None}, {total:.3f} с: "
+                        f"{self.breakdown(spans, total)}{profile_text}"
+                    )
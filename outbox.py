@@ -0,0 +1,229 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+# Приоритеты сообщений: меньше - раньше
+PRIORITY_PAYMENT = 0   # подтверждения оплаты и продления
+PRIORITY_NOTICE = 1    # единичные уведомления (отмена, продление администратором)
+PRIORITY_BULK = 2      # массовые напоминания и уведомления об окончании подписки
+
+# Общий лимит Telegram ~30 сообщений в секунду, держимся с запасом
+GLOBAL_RATE = 25
+# Не чаще одного сообщения в секунду в один чат
+PER_CHAT_INTERVAL = 1.0
+# Сколько раз повторять отправку при сетевых ошибках и RetryAfter
+MAX_ATTEMPTS = 5
+# Сколько одновременных запросов к Bot API допускается
+MAX_IN_FLIGHT = 10
+
+
+class TokenBucket:
+    """Token bucket: не больше rate операций в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        """Приостанавливает выдачу токенов (после RetryAfter от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        """Ждет, пока не появится свободный токен, и забирает его"""
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class _OutgoingRequest:
+    """Запрос в очереди на отправку"""
+
+    def __init__(self, chat_id: int, request: Callable[[], Awaitable[Any]], future: asyncio.Future):
+        self.chat_id = chat_id
+        self.request = request
+        self.future = future
+        self.attempts = 0
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений с учетом лимитов Telegram.
+
+    Сообщения отправляются по приоритету через общий token bucket, не чаще
+    PER_CHAT_INTERVAL в один чат. При TelegramRetryAfter отправка
+    приостанавливается на указанное время и повторяется. Фоновые рассылки
+    не блокируют вызывающий код: submit возвращает future, который можно
+    дождаться, если нужен результат.
+    """
+
+    def __init__(self, bot: Bot, rate: float = GLOBAL_RATE, per_chat_interval: float = PER_CHAT_INTERVAL,
+                 max_in_flight: int = MAX_IN_FLIGHT):
+        """
+        Args:
+            bot (Bot): Экземпляр бота
+            rate (float): Общий лимит сообщений в секунду
+            per_chat_interval (float): Минимальный интервал между сообщениями в один чат
+            max_in_flight (int): Максимум одновременных запросов к Bot API
+        """
+        self.bot = bot
+        self.per_chat_interval = per_chat_interval
+        self._bucket = TokenBucket(rate)
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._chat_ready_at: Dict[int, float] = {}
+        self._slots = asyncio.Semaphore(max_in_flight)
+        # Задачи отправки, которые сейчас выполняются (цикл событий держит на задачи только слабые ссылки)
+        self._in_flight: Set[asyncio.Task] = set()
+        self._delayed = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        """Количество сообщений, ожидающих отправки"""
+        return self._queue.qsize() + self._delayed
+
+    def submit(self, chat_id: int, request: Callable[[], Awaitable[Any]],
+               priority: int = PRIORITY_BULK) -> asyncio.Future:
+        """
+        Ставит запрос к Bot API в очередь
+
+        Args:
+            chat_id (int): Чат, в который отправляется сообщение
+            request: Функция без аргументов, возвращающая корутину запроса
+            priority (int): Приоритет (PRIORITY_PAYMENT, PRIORITY_NOTICE, PRIORITY_BULK)
+
+        Returns:
+            asyncio.Future: Результат запроса после отправки
+        """
+        future = asyncio.get_running_loop().create_future()
+        # Ошибку уже записали в лог; не требуем, чтобы future обязательно ждали
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._put(priority, _OutgoingRequest(chat_id, request, future))
+        return future
+
+    def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_BULK, **kwargs) -> asyncio.Future:
+        """Ставит в очередь bot.send_message"""
+        return self.submit(
+            chat_id,
+            lambda: self.bot.send_message(chat_id=chat_id, text=text, **kwargs),
+            priority
+        )
+
+    def _put(self, priority: int, item: _OutgoingRequest) -> None:
+        self._queue.put_nowait((priority, next(self._sequence), item))
+
+    def _put_later(self, delay: float, priority: int, item: _OutgoingRequest) -> None:
+        """Возвращает запрос в очередь через delay секунд"""
+        self._delayed += 1
+
+        def put():
+            self._delayed -= 1
+            self._put(priority, item)
+
+        asyncio.get_running_loop().call_later(delay, put)
+
+    def start(self) -> None:
+        """Запускает отправку сообщений из очереди"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5) -> None:
+        """Останавливает отправку, дав очереди и начатым запросам до timeout секунд на завершение"""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self.depth or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.depth or self._in_flight:
+            logging.warning(
+                f"Остановка очереди сообщений: не отправлено {self.depth}, прервано {len(self._in_flight)}"
+            )
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Прерываем отправки, не успевшие завершиться
+        in_flight = list(self._in_flight)
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+    async def _run(self):
+        """Выбирает сообщения по приоритету и отправляет с учетом лимитов"""
+        while True:
+            priority, _, item = await self._queue.get()
+            now = time.monotonic()
+            ready_at = self._chat_ready_at.get(item.chat_id, 0)
+            if ready_at > now:
+                self._put_later(ready_at - now, priority, item)
+                continue
+
+            await self._bucket.acquire()
+            self._chat_ready_at[item.chat_id] = time.monotonic() + self.per_chat_interval
+            await self._slots.acquire()
+            task = asyncio.create_task(self._deliver(priority, item))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+            # Не даем словарю расти бесконечно
+            if len(self._chat_ready_at) > 10000:
+                now = time.monotonic()
+                self._chat_ready_at = {k: v for k, v in self._chat_ready_at.items() if v > now}
+
+    async def _deliver(self, priority: int, item: _OutgoingRequest):
+        """Выполняет запрос и повторяет его при временных ошибках"""
+        try:
+            item.attempts += 1
+            result = await item.request()
+        except asyncio.CancelledError:
+            # Отправка прервана при остановке очереди
+            item.future.cancel()
+            raise
+        except TelegramRetryAfter as e:
+            logging.warning(f"Telegram попросил подождать {e.retry_after} с (чат {item.chat_id})")
+            self._bucket.pause(e.retry_after)
+            self._retry(priority, item, e, e.retry_after)
+        except TelegramForbiddenError as e:
+            # Пользователь заблокировал бота - повторять бессмысленно
+            logging.info(f"Сообщение в чат {item.chat_id} не доставлено: {e}")
+            item.future.set_exception(e)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self._retry(priority, item, e, 2 ** item.attempts)
+        except Exception as e:
+            logging.error(f"Ошибка при отправке сообщения в чат {item.chat_id}: {e}")
+            item.future.set_exception(e)
+        else:
+            item.future.set_result(result)
+        finally:
+            self._slots.release()
+
+    def _retry(self, priority: int, item: _OutgoingRequest, error: Exception, delay: float) -> None:
+        """Повторяет запрос через delay секунд или завершает его ошибкой"""
+        if item.attempts >= MAX_ATTEMPTS:
+            logging.error(f"Сообщение в чат {item.chat_id} не отправлено после {item.attempts} попыток: {error}")
+            item.future.set_exception(error)
+            return
+        self._chat_ready_at[item.chat_id] = time.monotonic() + delay
+        self._put_later(delay, priority, item)
@@ -1,16 +1,28 @@
-import asyncio
 import logging
 import datetime
+import secrets
+from typing import Optional
 from aiogram import Bot, types
-from aiogram import Dispatcher
-from yoomoney import Client, Quickpay
+from yoomoney_api import YooMoneyClient, PaymentLinkBuilder
 from keyboards import get_payment_keyboard, get_subscription_keyboard, get_main_keyboard
 from database import Database
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-import aiosqlite
 from subscription_manager import SubscriptionManager
-from utils import is_admin
-from aiogram.types import FSInputFile
+from utils import is_admin, from_timestamp, to_timestamp, now_timestamp
+from media import MediaRegistry
+from outbox import Outbox, PRIORITY_PAYMENT, PRIORITY_NOTICE
+from callback_router import ExtendCallback
+from payment_poller import PaymentPoller, POLL_INTERVAL
+
+# Оплаты, открытые не раньше этого срока, восстанавливаются после перезапуска
+RESUME_WINDOW = datetime.timedelta(hours=24)
+# Сколько оплат восстанавливается за один запуск
+MAX_RESUMED_INTENTS = 500
+# Восстановленная просроченная оплата проверяется еще столько времени
+RESUME_GRACE = datetime.timedelta(minutes=2)
+# Наибольшая комиссия ЮMoney за перевод с карты: она удерживается из суммы,
+# поэтому amount в истории операций меньше цены тарифа на эту долю
+MAX_COMMISSION = 0.03
 
 # Словарь с ценами и названиями подписок
 SUBSCRIPTION_PRICES = {
@@ -35,38 +47,94 @@ SUBSCRIPTION_PRICES = {
 }
 
 class PaymentHandler:
-    def __init__(self, bot: Bot, yoomoney_client: Client, wallet_number: str, db: Database):
+    def __init__(self, bot: Bot, yoomoney_client: YooMoneyClient, wallet_number: str, db: Database,
+                 media: MediaRegistry, outbox: Outbox, poll_interval: float = POLL_INTERVAL):
         self.bot = bot
+        self.media = media
+        self.outbox = outbox
         self.yoomoney_client = yoomoney_client
         self.wallet_number = wallet_number
         self.db = db
-        self.subscription_manager = SubscriptionManager(bot, db.db_path)
-        self._check_subscriptions_task = None
+        self.payment_links = PaymentLinkBuilder(wallet_number)
+        self.subscription_manager = SubscriptionManager(bot, db, outbox)
+        self.payment_poller = PaymentPoller(
+            yoomoney_client,
+            on_paid=self._settle_payment,
+            on_timeout=self._payment_timed_out,
+            interval=poll_interval
+        )
 
     async def start_background_tasks(self):
-        """Запускает фоновые задачи"""
-        self._check_subscriptions_task = asyncio.create_task(self._check_subscriptions_loop())
+        """Запускает фоновые задачи (только на экземпляре-лидере)"""
+        # Опрос запускается первым: без него watch не добавляет оплаты в реестр
+        self.payment_poller.start()
+        await self.resume_payment_intents()
 
     async def stop_background_tasks(self):
         """Останавливает фоновые задачи"""
-        if self._check_subscriptions_task:
-            self._check_subscriptions_task.cancel()
-            try:
-                await self._check_subscriptions_task
-            except asyncio.CancelledError:
-                pass
+        await self.payment_poller.stop()
+        self.payment_poller.clear()
+
+    async def close(self):
+        """Закрывает соединения при завершении работы"""
+        await self.payment_links.close()
+
+    async def resume_payment_intents(self, grace: Optional[datetime.timedelta] = RESUME_GRACE) -> int:
+        """
+        Возвращает в опрос оплаты из базы: открытые до перезапуска или
+        созданные другими экземплярами бота.
+
+        Восстанавливаются только последние MAX_RESUMED_INTENTS оплат не старше
+        RESUME_WINDOW; более старые закрываются как просроченные. Просроченные
+        за время простоя оплаты проверяются еще grace, чтобы найти переводы,
+        сделанные, пока бот не работал.
+
+        Returns:
+            int: Количество добавленных в опрос оплат
+        """
+        try:
+            window_start = to_timestamp(datetime.datetime.now() - RESUME_WINDOW)
+            expired = await self.db.expire_payment_intents(window_start)
+            intents = await self.db.get_pending_payment_intents(window_start, MAX_RESUMED_INTENTS)
+            intents = [intent for intent in intents if not self.payment_poller.is_pending(intent["label"])]
+            for intent in intents:
+                expires_at = from_timestamp(intent["expires_at"])
+                if grace is not None:
+                    expires_at = max(expires_at, datetime.datetime.now() + grace)
+                self.payment_poller.watch(
+                    label=intent["label"],
+                    user_id=intent["user_id"],
+                    chat_id=intent["chat_id"],
+                    subscription_type=intent["subscription_type"],
+                    is_extension=bool(intent["is_extension"]),
+                    created_at=from_timestamp(intent["created_at"]),
+                    expires_at=expires_at
+                )
+            if intents or expired:
+                logging.info(f"Восстановлено ожидающих оплат: {len(intents)}, закрыто устаревших: {expired}")
+            return len(intents)
+        except Exception as e:
+            logging.error(f"Ошибка при восстановлении ожидающих оплат: {e}")
+            return 0
 
-    async def _check_subscriptions_loop(self):
-        """Цикл проверки подписок"""
-        while True:
-            try:
-                await self.subscription_manager.check_expiring_subscriptions()
-                await asyncio.sleep(300)  # Проверяем каждые 5 минут
-            except Exception as e:
-                logging.error(f"Ошибка в цикле проверки подписок: {e}")
-                await asyncio.sleep(60)
+    async def watch_payment(self, label: str, user_id: int, chat_id: int, subscription_type: str,
+                            is_extension: bool = False) -> None:
+        """Регистрирует оплату в общем опросе и сохраняет ее в базе"""
+        intent = self.payment_poller.watch(
+            label=label,
+            user_id=user_id,
+            chat_id=chat_id,
+            subscription_type=subscription_type,
+            is_extension=is_extension
+        )
+        await self.db.save_payment_intent({
+            **intent,
+            "created_at": to_timestamp(intent["created_at"]),
+            "expires_at": to_timestamp(intent["expires_at"])
+        })
 
-    async def assign_user_label(self, user_id: int, username: str, subscription_type: str) -> None:
+    async def assign_user_label(self, user_id: int, username: str, subscription_type: str,
+                                payment: dict = None) -> None:
         """
         Присваивает индивидуальный label пользователю после успешной оплаты
         
@@ -74,6 +142,7 @@ class PaymentHandler:
             user_id (int): ID пользователя в Telegram
             username (str): Имя пользователя
             subscription_type (str): Тип подписки (sub_basic, sub_standard, sub_premium)
+            payment (dict, optional): Оплата для журнала платежей (None в тестовом режиме)
         """
         try:
             # Получаем информацию о подписке
@@ -87,55 +156,64 @@ class PaymentHandler:
             # Формируем username_at
             username_at = f"@{username}" if username and username != "Unknown" else None
             
-            # Получаем информацию о пользователе
-            user = await self.db.get_user(user_id)
-            first_name = user["first_name"] if user else "Unknown"
-            
-            # Сохраняем информацию в базу данных
-            await self.db.create_user(
-                user_id=user_id,
-                first_name=first_name,
-                username=username,
-                username_at=username_at,
-                label=user_label,
-                subscription_start=start_time,
-                subscription_end=end_time
-            )
+            async with self.db.user_lock(user_id):
+                # Получаем информацию о пользователе
+                user = await self.db.get_user(user_id)
+                first_name = user["first_name"] if user else "Unknown"
+                
+                # Сохраняем информацию в базу данных (повторно зачисленная оплата пропускается)
+                created = await self.db.create_user(
+                    user_id=user_id,
+                    first_name=first_name,
+                    username=username,
+                    username_at=username_at,
+                    label=user_label,
+                    subscription_start=start_time,
+                    subscription_end=end_time,
+                    payment=payment
+                )
+            if not created:
+                return
             
             # Отправляем единое сообщение с информацией о подписке и кнопкой
-            photo = FSInputFile("imgs/3.png")
-            await self.bot.send_photo(
-                chat_id=user_id,
-                photo=photo,
-                caption=(
-                    "🎉 Поздравляем с успешной оплатой!\n\n"
-                    f"📅 Подписка активна до: {end_time.strftime('%d.%m.%Y %H:%M')}\n\n"
-                    "Нажмите кнопку ниже, чтобы присоединиться к нашему каналу:"
-                ),
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(
-                            text="📢 Присоединиться к каналу",
-                            url="https://t.me/+4_Qb6pPctkRkNGMy"
-                        )]
-                    ]
+            await self.outbox.submit(
+                user_id,
+                lambda: self.media.send_photo(
+                    self.bot.send_photo,
+                    "imgs/3.png",
+                    chat_id=user_id,
+                    caption=(
+                        "🎉 Поздравляем с успешной оплатой!\n\n"
+                        f"📅 Подписка активна до: {end_time.strftime('%d.%m.%Y %H:%M')}\n\n"
+                        "Нажмите кнопку ниже, чтобы присоединиться к нашему каналу:"
+                    ),
+                    reply_markup=InlineKeyboardMarkup(
+                        inline_keyboard=[
+                            [InlineKeyboardButton(
+                                text="📢 Присоединиться к каналу",
+                                url="https://t.me/+4_Qb6pPctkRkNGMy"
+                            )]
+                        ]
+                    ),
+                    parse_mode="Markdown"
                 ),
-                parse_mode="Markdown"
+                PRIORITY_PAYMENT
             )
             
             logging.info(f"Пользователю {user_id} присвоен label: {user_label}")
             
         except Exception as e:
             logging.error(f"Ошибка при присвоении label пользователю {user_id}: {e}")
-            await self.bot.send_message(
-                chat_id=user_id,
-                text="Произошла ошибка при присвоении статуса. Пожалуйста, обратитесь в поддержку."
+            self.outbox.send_message(
+                user_id,
+                "Произошла ошибка при присвоении статуса. Пожалуйста, обратитесь в поддержку.",
+                PRIORITY_PAYMENT
             )
 
-    async def process_subscription_choice(self, callback_query: types.CallbackQuery, test_mode: bool = False):
+    async def process_subscription_choice(self, callback_query: types.CallbackQuery, subscription_type: str,
+                                          test_mode: bool = False):
         """Обработчик выбора подписки"""
         try:
-            subscription_type = callback_query.data
             selected_sub = SUBSCRIPTION_PRICES.get(subscription_type)
             
             if not selected_sub:
@@ -145,17 +223,14 @@ class PaymentHandler:
             # Проверяем наличие активной подписки
             user_info = await self.subscription_manager.get_subscription_info(callback_query.from_user.id)
             if user_info and user_info.get("subscription_end"):
-                end_time = datetime.datetime.strptime(
-                    user_info["subscription_end"],
-                    "%d.%m.%Y %H:%M:%S"
-                )
+                end_time = from_timestamp(user_info["subscription_end"])
                 if end_time > datetime.datetime.now():
                     keyboard = InlineKeyboardMarkup(
                         inline_keyboard=[
                             [
                                 InlineKeyboardButton(
                                     text="✅ Продлить",
-                                    callback_data=f"extend_{subscription_type}"
+                                    callback_data=ExtendCallback(code=subscription_type).pack()
                                 ),
                                 InlineKeyboardButton(
                                     text="❌ Отмена",
@@ -180,14 +255,12 @@ class PaymentHandler:
                 )
                 return
             
-            # Создаем форму для оплаты через ЮMoney
-            quickpay = Quickpay(
-                receiver=self.wallet_number,
-                quickpay_form="shop",
+            # Формируем ссылку на оплату через ЮMoney
+            label = self.new_payment_label(callback_query.from_user.id, subscription_type)
+            payment_url = self.payment_links.build_url(
                 targets=f"Оплата {selected_sub['name']}",
-                paymentType="AC",
-                sum=selected_sub['amount'],
-                label=f"{callback_query.from_user.id}_{callback_query.data}"
+                amount=selected_sub['amount'],
+                label=label
             )
             
             await callback_query.message.answer(
@@ -195,36 +268,35 @@ class PaymentHandler:
                 "нажмите кнопку 'Оплатить' ниже.\n\n"
                 "⏳ После оплаты бот автоматически проверит статус платежа.\n"
                 "Время ожидания: 10 минут",
-                reply_markup=get_payment_keyboard(quickpay.redirected_url)
+                reply_markup=get_payment_keyboard(payment_url)
             )
             
-            # Запускаем проверку оплаты
-            asyncio.create_task(self.check_payment(
-                label=f"{callback_query.from_user.id}_{callback_query.data}",
-                chat_id=callback_query.message.chat.id
-            ))
+            # Регистрируем оплату в общем опросе
+            await self.watch_payment(
+                label=label,
+                user_id=callback_query.from_user.id,
+                chat_id=callback_query.message.chat.id,
+                subscription_type=subscription_type
+            )
             
         except Exception as e:
             logging.error(f"Ошибка при создании формы оплаты: {e}")
             await callback_query.message.answer("Произошла ошибка при создании формы оплаты. Попробуйте позже.")
 
-    async def process_extend_subscription(self, callback_query: types.CallbackQuery):
+    async def process_extend_subscription(self, callback_query: types.CallbackQuery, subscription_type: str):
         """Обработчик продления подписки"""
         try:
-            subscription_type = callback_query.data.replace("extend_", "")
             selected_sub = SUBSCRIPTION_PRICES.get(subscription_type)
             
             if not selected_sub:
                 await callback_query.answer("❌ Неверный тип подписки", show_alert=True)
                 return
 
-            quickpay = Quickpay(
-                receiver=self.wallet_number,
-                quickpay_form="shop",
+            label = self.new_payment_label(callback_query.from_user.id, subscription_type, is_extension=True)
+            payment_url = self.payment_links.build_url(
                 targets=f"Продление {selected_sub['name']}",
-                paymentType="AC",
-                sum=selected_sub['amount'],
-                label=f"{callback_query.from_user.id}_extend_{subscription_type}"
+                amount=selected_sub['amount'],
+                label=label
             )
             
             await callback_query.message.edit_text(
@@ -232,14 +304,16 @@ class PaymentHandler:
                 "нажмите кнопку 'Оплатить' ниже.\n\n"
                 "⏳ После оплаты бот автоматически проверит статус платежа.\n"
                 "Время ожидания: 10 минут",
-                reply_markup=get_payment_keyboard(quickpay.redirected_url)
+                reply_markup=get_payment_keyboard(payment_url)
             )
             
-            asyncio.create_task(self.check_payment(
-                label=f"{callback_query.from_user.id}_extend_{subscription_type}",
+            await self.watch_payment(
+                label=label,
+                user_id=callback_query.from_user.id,
                 chat_id=callback_query.message.chat.id,
+                subscription_type=subscription_type,
                 is_extension=True
-            ))
+            )
 
         except Exception as e:
             logging.error(f"Ошибка при создании формы продления: {e}")
@@ -261,108 +335,95 @@ class PaymentHandler:
             parse_mode="Markdown"
         )
 
-    async def check_payment(self, label: str, chat_id: int, is_extension: bool = False) -> bool:
-        """Проверяет статус платежа"""
-        try:
-            max_attempts = 30  # 30 попыток по 20 секунд
-            attempts = 0
-            
-            while attempts < max_attempts:
-                history = self.yoomoney_client.operation_history(
-                    label=label,
-                    from_date=datetime.datetime.now() - datetime.timedelta(minutes=10)
-                )
-                
-                for operation in history.operations:
-                    if operation.status == "success" and operation.label == label:
-                        label_parts = label.split("_")
-                        if len(label_parts) >= 2:
-                            user_id = int(label_parts[0])
-                            subscription_type = "_".join(label_parts[1:])
-                            
-                            if is_extension:
-                                # Продлеваем подписку
-                                await self.subscription_manager.extend_subscription(
-                                    user_id,
-                                    SUBSCRIPTION_PRICES[subscription_type]["duration"]
-                                )
-                            else:
-                                # Создаем новую подписку
-                                user_info = await self.subscription_manager.get_subscription_info(user_id)
-                                await self.assign_user_label(
-                                    user_id,
-                                    user_info.get("username", "Unknown") if user_info else "Unknown",
-                                    subscription_type
-                                )
-                            return True
-                
-                attempts += 1
-                await asyncio.sleep(20)
-            
-            await self.bot.send_message(
-                chat_id=chat_id,
-                text="❌ Время ожидания оплаты истекло. Пожалуйста, попробуйте оплатить снова."
+    @staticmethod
+    def new_payment_label(user_id: int, subscription_type: str, is_extension: bool = False) -> str:
+        """
+        Уникальный label для одной оплаты.
+
+        Label не повторяется между оплатами, поэтому старая операция с тем же
+        тарифом не может быть принята за новую.
+        """
+        prefix = f"{user_id}_extend_{subscription_type}" if is_extension else f"{user_id}_{subscription_type}"
+        return f"{prefix}_{secrets.token_hex(4)}"
+
+    @staticmethod
+    def is_underpaid(operation, price: float) -> bool:
+        """
+        Оплачено ли меньше цены тарифа (сумму в ссылке на оплату можно изменить).
+
+        Списанная с плательщика сумма из уведомления сравнивается с ценой,
+        зачисленная сумма из истории - с ценой за вычетом комиссии.
+        """
+        if operation.withdraw_amount is not None:
+            return operation.withdraw_amount < price
+        if operation.amount is None:
+            return True
+        return operation.amount < round(price * (1 - MAX_COMMISSION), 2)
+
+    async def _settle_payment(self, intent: dict, operation) -> None:
+        """Выдает подписку по оплате, найденной в общем опросе или в уведомлении"""
+        user_id = intent["user_id"]
+        subscription_type = intent["subscription_type"]
+        logging.info(f"Получена оплата {intent['label']} (операция {operation.operation_id})")
+
+        price = SUBSCRIPTION_PRICES[subscription_type]["amount"]
+        if self.is_underpaid(operation, price):
+            logging.warning(
+                f"Оплата {intent['label']} меньше цены тарифа {price}: зачислено {operation.amount}, "
+                f"списано {operation.withdraw_amount} (операция {operation.operation_id}), подписка не выдана"
             )
-            return False
-            
-        except Exception as e:
-            logging.error(f"Ошибка при проверке платежа: {e}")
-            await self.bot.send_message(
-                chat_id=chat_id,
-                text="Произошла ошибка при проверке оплаты. Попробуйте позже."
+            await self.db.set_payment_intent_status(intent["label"], "underpaid")
+            self.outbox.send_message(
+                intent["chat_id"],
+                "❌ Сумма оплаты меньше стоимости подписки. Пожалуйста, обратитесь в поддержку.",
+                PRIORITY_PAYMENT
             )
-            return False
+            return
 
-    async def process_check_payment(self, callback_query: types.CallbackQuery):
-        """Обработчик кнопки 'Я оплатил'"""
-        try:
-            # Получаем label из callback_data
-            label = callback_query.data.replace("check_payment_", "")
-            
-            # Проверяем статус платежа
-            history = self.yoomoney_client.operation_history(
-                label=label,
-                from_date=datetime.datetime.now() - datetime.timedelta(minutes=30)
-            )
-            
-            # Проверяем каждую операцию
-            for operation in history.operations:
-                if operation.status == "success" and operation.label == label:
-                    # Если найдена успешная операция, отправляем сообщение
-                    await callback_query.message.edit_text(
-                        "✅ Оплата успешно получена! Ваша подписка активирована.",
-                        reply_markup=None
-                    )
-                    return
-            
-            # Если оплата не найдена
-            await callback_query.answer(
-                "❌ Оплата пока не поступила. Если вы уже оплатили, подождите немного и попробуйте снова.",
-                show_alert=True
+        payment = {
+            "operation_id": operation.operation_id or f"label:{intent['label']}",
+            "label": intent["label"],
+            "user_id": user_id,
+            "amount": operation.amount if operation.amount is not None else price,
+            "subscription_type": subscription_type,
+            "is_extension": intent["is_extension"],
+            "paid_at": to_timestamp(operation.datetime) if operation.datetime else now_timestamp()
+        }
+
+        if intent["is_extension"]:
+            # Продлеваем подписку
+            await self.subscription_manager.extend_subscription(
+                user_id,
+                SUBSCRIPTION_PRICES[subscription_type]["duration"],
+                payment
             )
-                
-        except Exception as e:
-            logging.error(f"Ошибка при проверке оплаты: {e}")
-            await callback_query.answer(
-                "Произошла ошибка при проверке оплаты. Попробуйте позже.",
-                show_alert=True
+        else:
+            # Создаем новую подписку
+            user_info = await self.subscription_manager.get_subscription_info(user_id)
+            await self.assign_user_label(
+                user_id,
+                user_info.get("username", "Unknown") if user_info else "Unknown",
+                subscription_type,
+                payment
             )
 
-    def register_handlers(self, dp: Dispatcher):
-        """Регистрация обработчиков"""
-        dp.register_callback_query_handler(
-            self.process_subscription_choice,
-            lambda c: c.data in SUBSCRIPTION_PRICES.keys()
-        )
-        dp.register_callback_query_handler(
-            self.process_extend_subscription,
-            lambda c: c.data.startswith("extend_")
-        )
-        dp.register_callback_query_handler(
-            self.process_cancel_extend,
-            lambda c: c.data == "cancel_extend"
+    async def handle_notification(self, operation) -> bool:
+        """Зачисляет оплату из HTTP-уведомления ЮMoney через тот же путь, что и опрос"""
+        if await self.payment_poller.settle(operation.label, operation):
+            return True
+        # Оплату мог открыть другой экземпляр бота, а опрос ведет лидер:
+        # берем ее из базы (повторное зачисление отсечет журнал платежей)
+        intent = await self.db.get_payment_intent(operation.label)
+        if not intent or intent["status"] != "pending":
+            return False
+        await self._settle_payment({**intent, "is_extension": bool(intent["is_extension"])}, operation)
+        return True
+
+    async def _payment_timed_out(self, intent: dict) -> None:
+        """Сообщает пользователю, что время ожидания оплаты истекло"""
+        await self.db.set_payment_intent_status(intent["label"], "expired")
+        self.outbox.send_message(
+            intent["chat_id"],
+            "❌ Время ожидания оплаты истекло. Пожалуйста, попробуйте оплатить снова.",
+            PRIORITY_NOTICE
         )
-        dp.register_callback_query_handler(
-            self.process_check_payment,
-            lambda c: c.data == "check_payment"
-        ) 
@@ -0,0 +1,73 @@
+import hashlib
+import hmac
+import logging
+from typing import Awaitable, Callable, Mapping
+from aiohttp import web
+from yoomoney_api import Operation
+
+# Поля, из которых ЮMoney собирает строку для sha1_hash (порядок важен)
+SIGNED_FIELDS = (
+    "notification_type", "operation_id", "amount", "currency", "datetime",
+    "sender", "codepro", "notification_secret", "label"
+)
+
+
+def sign_notification(data: Mapping[str, str], secret: str) -> str:
+    """Считает sha1_hash уведомления так же, как ЮMoney"""
+    values = {**data, "notification_secret": secret}
+    payload = "&".join(str(values.get(field, "")) for field in SIGNED_FIELDS)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def verify_notification(data: Mapping[str, str], secret: str) -> bool:
+    """Проверяет sha1_hash уведомления секретом из настроек кошелька"""
+    received = data.get("sha1_hash", "")
+    return hmac.compare_digest(sign_notification(data, secret), received.lower())
+
+
+class PaymentNotificationHandler:
+    """
+    Прием HTTP-уведомлений ЮMoney о входящих переводах.
+
+    Проверяет подпись, пропускает переводы с протекцией и незачисленные
+    средства и передает операцию в on_operation. На корректные уведомления
+    отвечает 200, даже если label неизвестен: иначе ЮMoney будет повторять
+    отправку.
+    """
+
+    def __init__(self, secret: str, on_operation: Callable[[Operation], Awaitable[bool]]):
+        """
+        Args:
+            secret (str): Секрет для проверки подлинности уведомлений
+            on_operation: Корутина, зачисляющая операцию; возвращает True, если label ожидал оплаты
+        """
+        self.secret = secret
+        self.on_operation = on_operation
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Обработчик POST-запроса с уведомлением"""
+        data = dict(await request.post())
+        if not verify_notification(data, self.secret):
+            logging.warning(f"Уведомление ЮMoney с неверной подписью от {request.remote}")
+            return web.Response(status=403, text="invalid sha1_hash")
+
+        operation_id = data.get("operation_id")
+        label = data.get("label")
+        if data.get("codepro") == "true" or data.get("unaccepted") == "true":
+            logging.info(f"Уведомление ЮMoney {operation_id}: перевод еще не зачислен (label {label})")
+            return web.Response(text="ok")
+        if not label:
+            return web.Response(text="ok")
+
+        try:
+            settled = await self.on_operation(Operation.from_notification(data))
+        except Exception as e:
+            logging.error(f"Ошибка при обработке уведомления ЮMoney {operation_id}: {e}")
+            # ЮMoney повторит уведомление
+            return web.Response(status=500, text="error")
+
+        if settled:
+            logging.info(f"Оплата {label} подтверждена уведомлением ЮMoney (операция {operation_id})")
+        else:
+            logging.info(f"Уведомление ЮMoney {operation_id}: label {label} не ожидает оплаты")
+        return web.Response(text="ok")
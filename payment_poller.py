@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import datetime
+from typing import Awaitable, Callable, Dict, Optional
+from metrics import JOB_SECONDS
+from yoomoney_api import YooMoneyClient
+
+# Интервал между запросами истории операций
+POLL_INTERVAL = 20
+# Сколько ждем оплату по одной ссылке
+PAYMENT_TIMEOUT = datetime.timedelta(minutes=10)
+# Максимум записей, которые ЮMoney отдает за один запрос
+HISTORY_PAGE_SIZE = 100
+
+
+class PaymentPoller:
+    """
+    Единый опрос истории операций ЮMoney для всех ожидающих оплат.
+
+    Вместо отдельной задачи на каждую ссылку оплаты хранит реестр ожидающих
+    label и раз в POLL_INTERVAL секунд запрашивает историю один раз для всех.
+    Количество запросов к API зависит только от времени, а не от числа
+    открытых оплат.
+    """
+
+    def __init__(self, yoomoney_client: YooMoneyClient,
+                 on_paid: Callable[[Dict, object], Awaitable[None]],
+                 on_timeout: Callable[[Dict], Awaitable[None]],
+                 interval: float = POLL_INTERVAL,
+                 timeout: datetime.timedelta = PAYMENT_TIMEOUT):
+        """
+        Args:
+            yoomoney_client (YooMoneyClient): Асинхронный клиент ЮMoney
+            on_paid: Корутина, вызываемая с (intent, operation) при успешной оплате
+            on_timeout: Корутина, вызываемая с intent, если оплата не пришла вовремя
+            interval (float): Пауза между опросами в секундах
+            timeout (timedelta): Время ожидания оплаты по одной ссылке
+        """
+        self.yoomoney_client = yoomoney_client
+        self.on_paid = on_paid
+        self.on_timeout = on_timeout
+        self.interval = interval
+        self.timeout = timeout
+        self._pending: Dict[str, Dict] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending_count(self) -> int:
+        """Количество ожидающих оплат"""
+        return len(self._pending)
+
+    def is_pending(self, label: str) -> bool:
+        """Ожидается ли оплата по label"""
+        return label in self._pending
+
+    def watch(self, label: str, user_id: int, chat_id: int, subscription_type: str,
+              is_extension: bool = False, created_at: Optional[datetime.datetime] = None,
+              expires_at: Optional[datetime.datetime] = None) -> Dict:
+        """
+        Добавляет оплату в реестр ожидания.
+
+        Повторная регистрация того же label продлевает срок ожидания,
+        а не создает второй опрос. created_at и expires_at передаются при
+        восстановлении оплат после перезапуска.
+
+        Реестр ведется только при запущенном опросе (на лидере): больше его
+        никто не очищает. На остальных экземплярах оплата только возвращается
+        для записи в базу, откуда ее подхватит лидер.
+
+        Returns:
+            Dict: Данные ожидающей оплаты
+        """
+        created_at = created_at or datetime.datetime.now()
+        intent = {
+            "label": label,
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "subscription_type": subscription_type,
+            "is_extension": is_extension,
+            "created_at": created_at,
+            "expires_at": expires_at or created_at + self.timeout
+        }
+        if self._task is not None:
+            self._pending[label] = intent
+            self._wakeup.set()
+        return intent
+
+    def forget(self, label: str) -> Optional[Dict]:
+        """Убирает оплату из реестра и возвращает ее данные"""
+        return self._pending.pop(label, None)
+
+    def clear(self) -> None:
+        """Очищает реестр (оплаты остаются в базе и будут восстановлены)"""
+        self._pending.clear()
+
+    def start(self) -> None:
+        """Запускает цикл опроса"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll_loop())
+
+    async def stop(self) -> None:
+        """Останавливает цикл опроса"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _poll_loop(self):
+        """Цикл опроса: спит, пока реестр пуст"""
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            try:
+                with JOB_SECONDS.time(job="payment_poll"):
+                    await self.poll_once()
+            except Exception as e:
+                logging.error(f"Ошибка при опросе истории платежей: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def _fetch_paid_operations(self, from_date: datetime.datetime) -> Dict[str, object]:
+        """Возвращает успешные операции с момента from_date в виде {label: operation}"""
+        paid = {}
+        start_record = None
+        while True:
+            history = await self.yoomoney_client.operation_history(
+                type="deposition",
+                from_date=from_date,
+                start_record=start_record,
+                records=HISTORY_PAGE_SIZE
+            )
+            for operation in history.operations:
+                if operation.status == "success" and operation.label:
+                    paid[operation.label] = operation
+            start_record = history.next_record
+            if not start_record:
+                return paid
+
+    async def poll_once(self) -> None:
+        """Один проход: запрос истории и сопоставление операций с ожидающими label"""
+        if not self._pending:
+            return
+
+        oldest = min(intent["created_at"] for intent in self._pending.values())
+        paid = await self._fetch_paid_operations(oldest - datetime.timedelta(minutes=1))
+
+        now = datetime.datetime.now()
+        for label, intent in list(self._pending.items()):
+            operation = paid.get(label)
+            if operation is not None:
+                await self.settle(label, operation)
+            elif now >= intent["expires_at"]:
+                self._pending.pop(label, None)
+                try:
+                    await self.on_timeout(intent)
+                except Exception as e:
+                    logging.error(f"Ошибка при обработке просроченной оплаты {label}: {e}")
+
+    async def settle(self, label: str, operation) -> bool:
+        """
+        Зачисляет оплату по label, найденную опросом или пришедшую в уведомлении
+
+        Returns:
+            bool: True, если label ожидал оплаты (повторная оплата по нему не зачисляется)
+        """
+        intent = self._pending.pop(label, None)
+        if intent is None:
+            return False
+        try:
+            await self.on_paid(intent, operation)
+        except Exception as e:
+            logging.error(f"Ошибка при зачислении оплаты {label}: {e}")
+        return True
@@ -1,14 +1,14 @@
 import asyncio
-import logging
-from bot import main
+from logging_setup import setup_logging
 
 if __name__ == "__main__":
-    # Настройка логирования
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        filename='bot.log'  # Логи будут сохраняться в файл
-    )
-    
-    # Запуск бота
-    asyncio.run(main()) 
\ No newline at end of file
+    # Настройка логирования (до импорта бота: он пишет в лог при загрузке)
+    listener = setup_logging()
+    try:
+        from bot import main
+
+        # Запуск бота
+        asyncio.run(main())
+    finally:
+        # Дописываем записи, оставшиеся в очереди
+        listener.stop()
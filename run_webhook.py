@@ -0,0 +1,14 @@
+import asyncio
+from logging_setup import setup_logging
+
+if __name__ == "__main__":
+    # Настройка логирования (до импорта бота: он пишет в лог при загрузке)
+    listener = setup_logging()
+    try:
+        from bot import main
+
+        # Запуск бота в режиме webhook (нужны WEBHOOK_BASE_URL и WEBHOOK_SECRET)
+        asyncio.run(main("webhook"))
+    finally:
+        # Дописываем записи, оставшиеся в очереди
+        listener.stop()
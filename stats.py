@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from typing import Optional
+from database import Database
+from metrics import JOB_SECONDS
+
+# Интервал полного пересчета агрегатов для проверки расхождений, часов (0 - выключен)
+STATS_RECOMPUTE_HOURS = 24
+
+
+class StatsRecomputer:
+    """
+    Периодическая сверка агрегатов статистики с таблицей users.
+
+    Агрегаты обновляются в тех же транзакциях, что и записи подписок, поэтому
+    пересчет нужен только как страховка: он пишет в лог, сколько корзин
+    разошлось, и заменяет их пересчитанными значениями.
+    """
+
+    def __init__(self, db: Database, interval_hours: float = STATS_RECOMPUTE_HOURS):
+        """
+        Args:
+            db (Database): База данных
+            interval_hours (float): Интервал пересчета в часах (0 - не пересчитывать)
+        """
+        self.db = db
+        self.interval = interval_hours * 3600
+        self._task: Optional[asyncio.Task] = None
+
+    async def recompute(self) -> int:
+        """Пересчитывает агрегаты и возвращает количество расхождений"""
+        with JOB_SECONDS.time(job="stats_recompute"):
+            drift = await self.db.recompute_subscription_buckets()
+        if drift:
+            logging.warning(f"Пересчет статистики: исправлено расхождений в агрегатах: {drift}")
+        else:
+            logging.info("Пересчет статистики: расхождений нет")
+        return drift
+
+    def start(self) -> None:
+        """Запускает периодический пересчет"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает периодический пересчет"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.recompute()
+            except Exception as e:
+                logging.error(f"Ошибка при пересчете статистики: {e}")
@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+# Сколько пользователей держать в памяти
+USER_CACHE_SIZE = 10000
+# Через сколько секунд запись считается устаревшей
+USER_CACHE_TTL = 600
+
+
+class UserCache:
+    """
+    Ограниченный LRU-кеш строк таблицы users с временем жизни записей.
+
+    Кеш write-through: Database обновляет или сбрасывает запись при каждой
+    записи в базу, поэтому чтения на горячих путях не обращаются к диску.
+    """
+
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        """
+        Args:
+            maxsize (int): Максимальное количество записей
+            ttl (float): Время жизни записи в секундах
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[int, Tuple[float, Dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        """Возвращает копию записи пользователя или None, если ее нет или она устарела"""
+        item = self._items.get(user_id)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, row = item
+        if expires_at < time.monotonic():
+            del self._items[user_id]
+            self.misses += 1
+            return None
+        self._items.move_to_end(user_id)
+        self.hits += 1
+        return dict(row)
+
+    def set(self, user_id: int, row: Dict) -> None:
+        """Кладет запись пользователя в кеш, вытесняя самую старую при переполнении"""
+        self._items[user_id] = (time.monotonic() + self.ttl, dict(row))
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def update(self, user_id: int, **fields) -> None:
+        """Обновляет поля закешированной записи; если записи нет, ничего не делает"""
+        item = self._items.get(user_id)
+        if item is not None:
+            item[1].update(fields)
+
+    def invalidate(self, user_id: int) -> None:
+        """Удаляет запись пользователя из кеша"""
+        self._items.pop(user_id, None)
+
+    def warm(self, rows: Iterable[Dict]) -> int:
+        """Заполняет кеш строками из базы и возвращает количество добавленных"""
+        count = 0
+        for row in rows:
+            self.set(row["user_id"], row)
+            count += 1
+        return count
@@ -1,5 +1,9 @@
 import os
 import logging
+import datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
 
 def is_admin(user_id: int, admin_ids: list = None) -> bool:
     """
@@ -14,8 +18,41 @@ def is_admin(user_id: int, admin_ids: list = None) -> bool:
         from os import getenv
         admin_ids = list(map(int, getenv('ADMIN_IDS', '').split(',')))
     
-    logging.info(f"Checking admin access for user_id={user_id}, admin_ids={admin_ids}")
     is_admin = user_id in admin_ids
-    logging.info(f"Admin access result for user_id={user_id}: {is_admin}")
+    # Вызывается почти на каждое нажатие кнопки: только DEBUG и без форматирования заранее
+    logger.debug("Admin access for user_id=%s: %s", user_id, is_admin)
     
-    return is_admin 
\ No newline at end of file
+    return is_admin
+
+def to_timestamp(dt: datetime.datetime) -> int:
+    """
+    Переводит datetime в UTC epoch (секунды), в котором даты хранятся в базе
+
+    Args:
+        dt (datetime): Локальное время без часового пояса или aware datetime
+    """
+    return int(dt.timestamp())
+
+def from_timestamp(ts: Optional[int]) -> Optional[datetime.datetime]:
+    """
+    Переводит UTC epoch из базы в локальный datetime
+
+    Args:
+        ts (int, optional): Секунды с начала эпохи или None
+    """
+    if ts is None:
+        return None
+    return datetime.datetime.fromtimestamp(ts)
+
+def now_timestamp() -> int:
+    """Текущее время в UTC epoch (секунды)"""
+    return to_timestamp(datetime.datetime.now())
+
+def utc_date(ts: int) -> datetime.date:
+    """
+    День по UTC для epoch (по нему ведется дневная статистика)
+
+    Args:
+        ts (int): Секунды с начала эпохи
+    """
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).date()
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from typing import List, Optional
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+# Путь обработчика обновлений и адрес встроенного сервера по умолчанию
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8080
+
+
+def create_app(bot: Bot, dp: Dispatcher, secret_token: str, path: str = WEBHOOK_PATH) -> web.Application:
+    """
+    Создает aiohttp-приложение, принимающее обновления от Telegram
+
+    Запуск и остановка приложения вызывают dp.startup / dp.shutdown, поэтому
+    фоновые задачи бота запускаются так же, как при polling.
+    """
+    app = web.Application()
+    # Сначала обработчики диспетчера: при остановке они должны отработать
+    # до того, как SimpleRequestHandler закроет сессию бота
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret_token).register(app, path=path)
+    app.router.add_get("/healthz", health)
+    return app
+
+
+async def health(request: web.Request) -> web.Response:
+    """Проверка живости для балансировщика"""
+    return web.Response(text="ok")
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, base_url: str, secret_token: str,
+                      path: str = WEBHOOK_PATH, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                      allowed_updates: Optional[List[str]] = None) -> None:
+    """
+    Регистрирует webhook в Telegram и обслуживает обновления до остановки процесса
+
+    Args:
+        bot (Bot): Экземпляр бота
+        dp (Dispatcher): Диспетчер
+        base_url (str): Публичный адрес, по которому Telegram доставляет обновления
+        secret_token (str): Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+        path (str): Путь обработчика обновлений
+        host (str): Адрес, на котором слушает сервер
+        port (int): Порт сервера
+        allowed_updates (List[str], optional): Типы обновлений, которые нужно получать
+    """
+    app = create_app(bot, dp, secret_token, path)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        logging.info(f"Webhook-сервер запущен на {host}:{port}{path}")
+
+        # set_webhook идемпотентен: каждый экземпляр за балансировщиком
+        # регистрирует один и тот же адрес. При остановке webhook не удаляется,
+        # чтобы не отключить остальные экземпляры
+        await bot.set_webhook(
+            url=f"{base_url.rstrip('/')}{path}",
+            secret_token=secret_token,
+            allowed_updates=allowed_updates
+        )
+        logging.info("Webhook зарегистрирован в Telegram")
+
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
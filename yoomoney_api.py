@@ -0,0 +1,257 @@
+import logging
+import datetime
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+import aiohttp
+from metrics import YOOMONEY_ERRORS, YOOMONEY_SECONDS, record_span
+
+YOOMONEY_API_URL = "https://yoomoney.ru/api/"
+QUICKPAY_URL = "https://yoomoney.ru/quickpay/confirm.xml"
+
+# Таймауты запросов к API ЮMoney (секунды)
+REQUEST_TIMEOUT = 15
+CONNECT_TIMEOUT = 5
+# Размер пула keep-alive соединений
+POOL_SIZE = 10
+
+
+class YooMoneyError(Exception):
+    """Ошибка, которую вернуло API ЮMoney"""
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime.datetime]:
+    """Переводит дату из ответа API в локальное время без часового пояса"""
+    if not value:
+        return None
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+def _format_datetime(value: datetime.datetime) -> str:
+    """Форматирует дату для параметров запроса"""
+    return value.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+class Account:
+    """Информация о кошельке (ответ account-info)"""
+
+    def __init__(self, data: Dict):
+        self.account = data.get("account")
+        self.balance = data.get("balance")
+        self.currency = data.get("currency")
+        self.account_status = data.get("account_status")
+        self.account_type = data.get("account_type")
+
+
+class Operation:
+    """Операция из истории кошелька"""
+
+    def __init__(self, data: Dict):
+        self.operation_id = data.get("operation_id")
+        self.status = data.get("status")
+        self.datetime = _parse_datetime(data.get("datetime"))
+        self.title = data.get("title")
+        self.direction = data.get("direction")
+        self.amount = data.get("amount")
+        # Сумма, списанная с плательщика (есть только в уведомлениях)
+        self.withdraw_amount = data.get("withdraw_amount")
+        self.label = data.get("label")
+        self.type = data.get("type")
+
+
+    @classmethod
+    def from_notification(cls, data: Dict) -> "Operation":
+        """Операция из HTTP-уведомления о входящем переводе"""
+        try:
+            amount = float(data.get("amount"))
+        except (TypeError, ValueError):
+            amount = None
+        try:
+            withdraw_amount = float(data.get("withdraw_amount"))
+        except (TypeError, ValueError):
+            withdraw_amount = None
+        return cls({
+            "operation_id": data.get("operation_id"),
+            "status": "success",
+            "datetime": data.get("datetime"),
+            "direction": "in",
+            "amount": amount,
+            "withdraw_amount": withdraw_amount,
+            "label": data.get("label"),
+            "type": data.get("notification_type")
+        })
+
+
+class History:
+    """Страница истории операций (ответ operation-history)"""
+
+    def __init__(self, data: Dict):
+        self.next_record = data.get("next_record")
+        self.operations: List[Operation] = [Operation(item) for item in data.get("operations", [])]
+
+
+class YooMoneyClient:
+    """
+    Асинхронный клиент API ЮMoney.
+
+    Все запросы идут через одну aiohttp-сессию с пулом keep-alive соединений
+    и таймаутами, поэтому не блокируют цикл событий бота.
+    """
+
+    def __init__(self, token: str, base_url: str = YOOMONEY_API_URL,
+                 timeout: float = REQUEST_TIMEOUT, pool_size: int = POOL_SIZE):
+        """
+        Args:
+            token (str): OAuth-токен кошелька
+            base_url (str): Адрес API (для тестовых стендов)
+            timeout (float): Общий таймаут запроса в секундах
+            pool_size (int): Максимум одновременных соединений
+        """
+        self.token = token
+        self.base_url = base_url.rstrip("/") + "/"
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=CONNECT_TIMEOUT)
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию, создавая ее при первом обращении"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=self.timeout,
+                headers={"Authorization": f"Bearer {self.token}"}
+            )
+        return self._session
+
+    async def close(self) -> None:
+        """Закрывает пул соединений"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _request(self, method: str, data: Optional[Dict] = None) -> Dict:
+        """Выполняет POST-запрос к методу API и возвращает JSON ответа"""
+        session = self._get_session()
+        start = time.perf_counter()
+        try:
+            async with session.post(self.base_url + method, data=data or {}) as response:
+                if response.status == 401:
+                    raise YooMoneyError("Неверный или просроченный токен ЮMoney")
+                response.raise_for_status()
+                result = await response.json(content_type=None)
+            if result.get("error"):
+                raise YooMoneyError(f"{method}: {result['error']}")
+        except Exception as e:
+            YOOMONEY_ERRORS.inc(method=method, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            YOOMONEY_SECONDS.observe(elapsed, method=method)
+            record_span(f"yoomoney.{method}", elapsed)
+        return result
+
+    async def account_info(self) -> Account:
+        """Возвращает информацию о кошельке"""
+        return Account(await self._request("account-info"))
+
+    async def operation_history(self, type: Optional[str] = None, label: Optional[str] = None,
+                                from_date: Optional[datetime.datetime] = None,
+                                till_date: Optional[datetime.datetime] = None,
+                                start_record: Optional[str] = None,
+                                records: Optional[int] = None,
+                                details: Optional[bool] = None) -> History:
+        """Возвращает страницу истории операций кошелька"""
+        payload = {}
+        if type is not None:
+            payload["type"] = type
+        if label is not None:
+            payload["label"] = label
+        if from_date is not None:
+            payload["from"] = _format_datetime(from_date)
+        if till_date is not None:
+            payload["till"] = _format_datetime(till_date)
+        if start_record is not None:
+            payload["start_record"] = start_record
+        if records is not None:
+            payload["records"] = str(records)
+        if details is not None:
+            payload["details"] = "true" if details else "false"
+        return History(await self._request("operation-history", payload))
+
+
+class PaymentLinkBuilder:
+    """
+    Формирует ссылки на форму оплаты QuickPay локально, без запроса к ЮMoney.
+
+    Неизменная часть параметров (получатель, назначение, сумма) кешируется
+    для каждого тарифа, к ней дописывается только label конкретной оплаты.
+    """
+
+    def __init__(self, receiver: str, quickpay_url: str = QUICKPAY_URL,
+                 quickpay_form: str = "shop", payment_type: str = "AC"):
+        """
+        Args:
+            receiver (str): Номер кошелька получателя
+            quickpay_url (str): Адрес формы QuickPay
+            quickpay_form (str): Тип формы
+            payment_type (str): Способ оплаты (AC - банковская карта)
+        """
+        self.receiver = receiver
+        self.quickpay_url = quickpay_url
+        self.quickpay_form = quickpay_form
+        self.payment_type = payment_type
+        self._tariff_queries: Dict[Tuple[str, float], str] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _tariff_query(self, targets: str, amount: float) -> str:
+        """Возвращает закешированную строку параметров для тарифа"""
+        key = (targets, amount)
+        query = self._tariff_queries.get(key)
+        if query is None:
+            query = urlencode({
+                "receiver": self.receiver,
+                "quickpay-form": self.quickpay_form,
+                "targets": targets,
+                "paymentType": self.payment_type,
+                "sum": amount
+            })
+            self._tariff_queries[key] = query
+        return query
+
+    def build_url(self, targets: str, amount: float, label: str) -> str:
+        """
+        Возвращает ссылку на форму оплаты
+
+        Args:
+            targets (str): Назначение платежа
+            amount (float): Сумма
+            label (str): Метка, по которой будет найдена оплата
+        """
+        return f"{self.quickpay_url}?{self._tariff_query(targets, amount)}&{urlencode({'label': label})}"
+
+    async def resolve(self, url: str) -> str:
+        """
+        Проходит по редиректам формы и возвращает конечную ссылку на оплату.
+
+        Не обязателен: ссылка из build_url открывается в браузере и без этого.
+        При ошибке возвращает исходную ссылку.
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+            )
+        try:
+            async with self._session.post(url, allow_redirects=True) as response:
+                return str(response.url)
+        except Exception as e:
+            logging.error(f"Не удалось получить ссылку на оплату: {e}")
+            return url
+
+    async def close(self) -> None:
+        """Закрывает сессию, если она открывалась"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None